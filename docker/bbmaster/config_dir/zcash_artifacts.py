@@ -0,0 +1,37 @@
+"""
+Serves the build artifacts kept on the master as static files.
+
+Steps upload artifacts which are too large for the buildbot database, like
+the perf profiles of the benchmarks or the full logs kept by the workers, to
+directories on the master. ArtifactsService serves each directory under its
+own URL prefix.
+"""
+
+import os
+
+from twisted.application import strports
+from twisted.internet import defer
+from twisted.web import resource, server, static
+
+from buildbot.util import service
+
+class ArtifactsService(service.BuildbotService):
+    """HTTP server for the artifact directories on the master.
+
+    `dirs` maps URL prefixes to directories. The steps link to the artifacts
+    under https://<buildbot_host>/artifacts/, which the front end proxies to
+    `port` with the prefix stripped.
+    """
+    name = 'artifacts'
+
+    @defer.inlineCallbacks
+    def reconfigService(self, port, dirs, **kwargs):
+        root = resource.Resource()
+        for name, path in sorted(dirs.items()):
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            root.putChild(name.encode('utf8'), static.File(path))
+        if getattr(self, 'port_service', None) is not None:
+            yield self.port_service.disownServiceParent()
+        self.port_service = strports.service('tcp:%d' % port, server.Site(root))
+        yield self.port_service.setServiceParent(self)
@@ -0,0 +1,140 @@
+"""
+Serves code coverage reports, generating the lcov HTML on first request.
+
+ZcashCoverageFactory uploads a single `<buildnumber>-coverage.tar.gz` per
+build, holding the lcov tracefiles and the source files they cover. The HTML
+for `/<buildnumber>-<report>.coverage/` is generated from it by genhtml when
+it is first requested and kept next to the tarballs afterwards.
+"""
+
+import os
+import re
+import shutil
+import subprocess
+import tarfile
+import tempfile
+
+from twisted.application import strports
+from twisted.internet import defer, threads
+from twisted.python import log
+from twisted.web import resource, server, static
+
+from buildbot.util import service
+
+# report name in the URL -> tracefile produced by `make <tracefile>`
+COVERAGE_REPORTS = {
+    'zcash-gtest': 'zcash-gtest_coverage.info',
+    'test_zcash': 'test_bitcoin_coverage.info',
+    'total': 'total_coverage.info',
+}
+
+_report_re = re.compile(r'^(\d+)-(%s)\.coverage$' % '|'.join(
+    re.escape(name) for name in COVERAGE_REPORTS))
+
+def _safe_members(archive):
+    for member in archive.getmembers():
+        name = member.name
+        if name.startswith('/') or '..' in name.split('/'):
+            raise ValueError('refusing to extract %r' % name)
+        if not (member.isfile() or member.isdir()):
+            raise ValueError('refusing to extract %r' % name)
+        yield member
+
+def generate_html(tarball, tracefile, htmldir):
+    """Extract tarball and run genhtml on one of its tracefiles."""
+    workdir = tempfile.mkdtemp(dir=os.path.dirname(tarball))
+    try:
+        with tarfile.open(tarball) as archive:
+            archive.extractall(workdir, members=_safe_members(archive))
+        # the tracefiles use paths relative to the zcash checkout
+        subprocess.check_call(
+            ['genhtml', '--quiet', '-s', '-o', htmldir + '.tmp', tracefile],
+            cwd=workdir)
+        os.rename(htmldir + '.tmp', htmldir)
+    finally:
+        shutil.rmtree(workdir)
+        shutil.rmtree(htmldir + '.tmp', ignore_errors=True)
+
+class CoverageResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, service):
+        resource.Resource.__init__(self)
+        self.service = service
+
+    def render_GET(self, request):
+        path = [p.decode('utf8') for p in request.postpath]
+        m = _report_re.match(path[0]) if path else None
+        if m is None or '..' in path:
+            request.setResponseCode(404)
+            return b'no such coverage report'
+        if len(path) == 1:
+            # relative, the service is usually proxied under a prefix
+            request.redirect(path[0].encode('utf8') + b'/')
+            return b''
+
+        buildnumber, report = m.groups()
+        d = self.service.ensureHtml(buildnumber, report)
+
+        @d.addCallback
+        def serve(htmldir):
+            if htmldir is None:
+                request.setResponseCode(404)
+                request.write(b'no coverage uploaded for this build')
+                request.finish()
+                return
+            filename = os.path.join(htmldir, *path[1:])
+            if os.path.isdir(filename):
+                filename = os.path.join(filename, 'index.html')
+            body = static.File(filename).render_GET(request)
+            if body != server.NOT_DONE_YET:
+                request.write(body)
+                request.finish()
+
+        @d.addErrback
+        def failed(f):
+            log.err(f, 'while generating coverage report')
+            request.setResponseCode(500)
+            request.write(b'could not generate the coverage report')
+            request.finish()
+
+        return server.NOT_DONE_YET
+
+class CoverageService(service.BuildbotService):
+    """HTTP server for the coverage reports uploaded to coverage_dir.
+
+    The steps link to the reports under https://<buildbot_host>/code-coverage/,
+    which the front end proxies to `port` with the prefix stripped.
+    """
+    name = 'coverage'
+
+    @defer.inlineCallbacks
+    def reconfigService(self, port, coverage_dir, **kwargs):
+        self.coverage_dir = coverage_dir
+        # genhtml is expensive, run one at a time
+        self.lock = defer.DeferredLock()
+        root = CoverageResource(self)
+        if getattr(self, 'port_service', None) is not None:
+            yield self.port_service.disownServiceParent()
+        self.port_service = strports.service('tcp:%d' % port, server.Site(root))
+        yield self.port_service.setServiceParent(self)
+
+    def ensureHtml(self, buildnumber, report):
+        """Return a Deferred firing with the HTML directory, or None."""
+        return self.lock.run(self._ensureHtml, buildnumber, report)
+
+    def _ensureHtml(self, buildnumber, report):
+        htmldir = os.path.join(
+            self.coverage_dir, 'html', '%s-%s.coverage' % (buildnumber, report))
+        if os.path.isdir(htmldir):
+            return defer.succeed(htmldir)
+        tarball = os.path.join(
+            self.coverage_dir, '%s-coverage.tar.gz' % buildnumber)
+        if not os.path.exists(tarball):
+            return defer.succeed(None)
+        if not os.path.isdir(os.path.dirname(htmldir)):
+            os.makedirs(os.path.dirname(htmldir))
+        d = threads.deferToThread(
+            generate_html, tarball, COVERAGE_REPORTS[report], htmldir)
+        d.addCallback(lambda _: htmldir)
+        return d
@@ -1,29 +1,66 @@
+import hashlib
+import json
 import os
 import urllib.request, urllib.parse, urllib.error
 
 from buildbot.plugins import steps, util
 
+from zcash_coverage import (
+    COVERAGE_REPORTS,
+)
 from zcash_helpers import (
     GoodRepo,
+    load_impact_rules,
     read_or_generate_secret,
 )
 from zcash_steps import (
+    AddURLs,
+    CallgrindTestRunner,
     CargoBenchRunner,
+    ChangeImpact,
+    ClaimSharedBuild,
     ExpectedFailuresRunner,
     InitialBlockDownloadTimeRunner,
     MemoryTestRunner,
     MergeTestDriver,
-    PerformanceTestRunner,
+    PublishSharedBuild,
+    SanitizerTestShards,
     TimingTestRunner,
+    ValgrindTestRunner,
     getPerfJson,
+    impacted,
+    shared_build_is,
+    shared_build_wanted,
 )
 
 eu = os.path.expanduser
 
-CODESPEED_URL = 'https://speed.z.cash/'
+CODESPEED_URL = os.environ.get('CODESPEED_URL', 'https://speed.z.cash/')
 CODESPEED_CERT = eu('~/speed_z_cash.pem')
 CODESPEED_PASS = read_or_generate_secret(eu('~/codespeed.password'), False)
 
+ARTIFACTS_DIR = os.environ.get('BUILDBOT_ARTIFACTS_DIR', '/var/lib/buildbot/artifacts')
+
+# coverage tarballs, see ZcashCoverageFactory; read by CoverageService
+COVERAGE_DIR = os.environ.get('BUILDBOT_COVERAGE_DIR', os.path.join(ARTIFACTS_DIR, 'coverage'))
+
+# perf profiles of the benchmarks, see PerformanceTestRunner; served by
+# ArtifactsService
+PROFILE_DIR = util.Interpolate(
+    os.path.join(ARTIFACTS_DIR, 'profiles') + '/%(prop:buildername)s/%(prop:buildnumber)s')
+PROFILE_URL = util.Interpolate(
+    'https://{{ buildbot_host }}/artifacts/profiles/%(prop:buildername)s/%(prop:buildnumber)s')
+
+# full logs of the steps which only send the lines they parse to the master,
+# see ReducedLogsMixin; served like the profiles
+LOGS_DIR = util.Interpolate(
+    os.path.join(ARTIFACTS_DIR, 'logs') + '/%(prop:buildername)s/%(prop:buildnumber)s')
+LOGS_URL = util.Interpolate(
+    'https://{{ buildbot_host }}/artifacts/logs/%(prop:buildername)s/%(prop:buildnumber)s')
+
+IMPACT_RULES = load_impact_rules(
+    os.path.join(os.path.dirname(__file__), 'merge_test_impact.json'))
+
 REPOS = []
 PROJECT = '{{ homu_github_repo_name }}'
 for HOST in ['github.com']:
@@ -65,6 +102,8 @@ def time(benchmark, *args, **kw):
     return TimingTestRunner(
         benchmark,
         args,
+        profile_dir=PROFILE_DIR,
+        profile_url=PROFILE_URL,
         name=name,
         description=name,
         timeout=None,
@@ -76,6 +115,8 @@ def memory(benchmark, *args, **kw):
     return MemoryTestRunner(
         benchmark,
         args,
+        logs_dir=LOGS_DIR,
+        logs_url=LOGS_URL,
         name=name,
         description=name,
         timeout=None,
@@ -84,18 +125,33 @@ def memory(benchmark, *args, **kw):
 def valgrind(benchmark, *args, **kw):
     name = kw.pop('name', 'valgrind %s' % benchmark)
     assert kw == {}, 'Unexpected keywords: {!r}'.format(kw)
-    return PerformanceTestRunner(
-        'valgrind',
+    return ValgrindTestRunner(
         benchmark,
         args,
+        logs_dir=LOGS_DIR,
+        logs_url=LOGS_URL,
+        name=name,
+        description=name,
+        timeout=None,
+    )
+
+def callgrind(benchmark, *args, **kw):
+    name = kw.pop('name', 'callgrind %s' % benchmark)
+    assert kw == {}, 'Unexpected keywords: {!r}'.format(kw)
+    return CallgrindTestRunner(
+        benchmark,
+        args,
+        logs_dir=LOGS_DIR,
+        logs_url=LOGS_URL,
         name=name,
         description=name,
         timeout=None,
     )
 
 def asan(stage_name):
-    return steps.ShellCommand(
-        command=['./qa/zcash/full_test_suite.py', stage_name],
+    return SanitizerTestShards(
+        stage_name,
+        shard_memory=2048,
         name=stage_name,
         env={
             'ASAN_OPTIONS': 'symbolize=1:report_globals=1:check_initialization_order=true:detect_stack_use_after_return=true',
@@ -103,6 +159,29 @@ def asan(stage_name):
         },
     )
 
+def tsan(stage_name):
+    # TSan needs several times the memory of ASan
+    return SanitizerTestShards(
+        stage_name,
+        shard_memory=4096,
+        name=stage_name,
+    )
+
+# memory the worker can use in MiB: MemAvailable, capped by the cgroup limit
+# of the worker's container
+available_memory = steps.SetPropertyFromCommand(
+    command=['sh', '-c',
+        'avail=$(awk \'/^MemAvailable:/ {print int($2 / 1024)}\' /proc/meminfo);'
+        ' limit=$(cat /sys/fs/cgroup/memory/memory.limit_in_bytes 2>/dev/null'
+        ' || cat /sys/fs/cgroup/memory.max 2>/dev/null);'
+        ' case "$limit" in'
+        ' ""|max) echo $avail;;'
+        ' *) limit=$((limit / 1048576)); echo $((limit < avail ? limit : avail));;'
+        ' esac'],
+    property='available_memory',
+    name='available memory',
+)
+
 @util.renderer
 def nproc(props):
     name = props.getProperty('workername')
@@ -118,8 +197,31 @@ def configure_flags(base_flags):
         return ' '.join(base_flags + configure_flags)
     return inner
 
+def shared_build_key(share_group, base_flags, build_args):
+    @util.renderer
+    def inner(props):
+        configure_flags = props.getProperty('configure_flags', default=[])
+        key = json.dumps([
+            share_group,
+            props.getProperty('got_revision'),
+            props.getProperty('platform'),
+            base_flags + configure_flags,
+            build_args,
+        ])
+        return hashlib.sha1(key.encode('utf8')).hexdigest()
+    return inner
+
+def build_needed(step):
+    return impacted('build.sh')(step) and step.getProperty('shared_build') != 'download'
+
 class ZcashBaseFactory(util.BuildFactory):
     configure_flags = ['--enable-werror']
+    build_args = []
+    # Builders of the same share group share one compiled tree between their
+    # builds of the same revision, platform, configure flags and build args,
+    # see ClaimSharedBuild. Only for builders whose flags another builder
+    # has too: the tree is uploaded to the master for every waiting build.
+    share_group = None
 
     def __init__(self):
         util.BuildFactory.__init__(self, [
@@ -146,21 +248,104 @@ class ZcashBaseFactory(util.BuildFactory):
         pass
 
     def _addBuildSteps(self):
+        if self.share_group:
+            self._addSharedBuildDownloadSteps()
+
         self.addStep(
             steps.ShellCommand(
-                command=['./zcutil/build.sh', util.Interpolate('-j%(prop:numcpus)s')],
+                command=['./zcutil/build.sh']+self.build_args+[util.Interpolate('-j%(prop:numcpus)s')],
                 name='build.sh',
                 env={'CONFIGURE_FLAGS': configure_flags(self.configure_flags)},
                 haltOnFailure=True,
+                doStepIf=build_needed,
             ))
 
+        if self.share_group:
+            self._addSharedBuildUploadSteps()
+
+    def _addSharedBuildDownloadSteps(self):
+        self.addSteps([
+            steps.SetPropertyFromCommand(
+                command=['sh', '-c', '. /etc/os-release && echo $ID$VERSION_ID'],
+                property='platform',
+                doStepIf=impacted('build.sh'),
+            ),
+            ClaimSharedBuild(
+                os.path.join(ARTIFACTS_DIR, 'builds'),
+                shared_build_key(self.share_group, self.configure_flags, self.build_args),
+                doStepIf=impacted('build.sh'),
+            ),
+            steps.FileDownload(
+                mastersrc=util.Property('shared_build_path'),
+                workerdest='../shared-build.tar.gz',
+                haltOnFailure=True,
+                doStepIf=shared_build_is('download'),
+            ),
+            # The outputs keep the mtimes they had on the compiling worker,
+            # so make sees them in the order they were built. Text files
+            # holding the compiling worker's build directory (configure and
+            # libtool output, tests-config.sh, the depends prefix) are
+            # relocated to this one. The checkout is then dated back to the
+            # commit, which came before any output, so make rebuilds nothing.
+            steps.ShellCommand(
+                command=['sh', '-c',
+                    'tar -xzf ../shared-build.tar.gz'
+                    ' && from="$(cat .shared-build-dir)" && rm .shared-build-dir'
+                    ' && if [ "$from" != "$PWD" ]; then'
+                    '   tar -tzf ../shared-build.tar.gz'
+                    '   | grep -v -e "/$" -e "^.shared-build-dir$"'
+                    '   | xargs -d "\\n" grep -lIF -- "$from"'
+                    '   | while read -r f; do'
+                    '     [ -L "$f" ] && continue;'
+                    '     m="$(stat -c %Y "$f")"'
+                    '     && sed -i "s|$from|$PWD|g" "$f"'
+                    '     && touch -d "@$m" "$f" || exit 1;'
+                    '   done;'
+                    ' fi'
+                    ' && git ls-files -z'
+                    ' | xargs -0 touch -h -d "@$(git log -1 --format=%ct)"'],
+                name='extract shared build',
+                haltOnFailure=True,
+                doStepIf=shared_build_is('download'),
+            ),
+        ])
+
+    def _addSharedBuildUploadSteps(self):
+        self.addSteps([
+            # everything the build added to the checkout, except the
+            # depends download and package caches, and the build directory
+            # the paths in it are relative to
+            steps.ShellCommand(
+                command=['sh', '-c',
+                    'pwd > .shared-build-dir'
+                    ' && git ls-files -z --others'
+                    ' | grep -zv -e ^depends/sources/ -e ^depends/work/ -e ^depends/built/'
+                    ' | tar -czf ../shared-build.tar.gz --null -T -'],
+                name='pack shared build',
+                doStepIf=shared_build_wanted,
+            ),
+            steps.FileUpload(
+                workersrc='../shared-build.tar.gz',
+                masterdest=util.Interpolate('%(prop:shared_build_path)s.partial'),
+                mode=0o644,
+                name='upload shared build',
+                doStepIf=shared_build_wanted,
+            ),
+            PublishSharedBuild(
+                ['build.sh', 'pack shared build', 'upload shared build'],
+                doStepIf=shared_build_is('upload'),
+            ),
+        ])
+
 class ZcashMergeTestFactory(ZcashBaseFactory):
+    share_group = 'default-flags'
     def __init__(self):
         ZcashBaseFactory.__init__(self)
 
         self.addStep(MergeTestDriver())
 
     def _addPreBuildSteps(self):
+        self.addStep(ChangeImpact(IMPACT_RULES))
         self.addStep(
             steps.PyFlakes(
                 command=['pyflakes', 'qa', 'src', 'zcutil'],
@@ -168,19 +353,16 @@ class ZcashMergeTestFactory(ZcashBaseFactory):
                 flunkOnWarnings=True,
                 flunkOnFailure=True,
                 alwaysRun=True,
+                doStepIf=impacted('pyflakes'),
             ))
 
 class ZcashProtonMergeTestFactory(ZcashMergeTestFactory):
-    def _addBuildSteps(self):
-        self.addStep(
-            steps.ShellCommand(
-                command=['./zcutil/build.sh', '--enable-proton', util.Interpolate('-j%(prop:numcpus)s')],
-                name='build.sh',
-                env={'CONFIGURE_FLAGS': configure_flags(self.configure_flags)},
-                haltOnFailure=True,
-            ))
+    build_args = ['--enable-proton']
+    # no other builder builds proton
+    share_group = None
 
 class ZcashExpectedFailuresFactory(ZcashBaseFactory):
+    share_group = 'default-flags'
     def __init__(self):
         ZcashBaseFactory.__init__(self)
 
@@ -264,6 +446,8 @@ class ZcashInitialBlockDownloadTimeFactory(ZcashBaseFactory):
             sh('touch', 'ibd-datadir/zcash.conf', name='Create zcash.conf'),
             InitialBlockDownloadTimeRunner(
                 'ibd-datadir',
+                logs_dir=LOGS_DIR,
+                logs_url=LOGS_URL,
                 name='time-InitialBlockDownload',
             ),
             steps.RemoveDirectory(
@@ -290,24 +474,29 @@ class ZcashCoverageFactory(ZcashBaseFactory):
     def __init__(self):
         ZcashBaseFactory.__init__(self)
 
+        tracefiles = sorted(COVERAGE_REPORTS.values())
         self.addSteps([
-            sh('make', 'cov'),
-            steps.DirectoryUpload(
-                workersrc="./zcash-gtest.coverage",
-                masterdest=util.Interpolate("{{ buildbot_coverage_dir }}/%(prop:buildnumber)s-zcash-gtest.coverage"),
-                url=util.Interpolate("https://{{ buildbot_host }}/code-coverage/%(prop:buildnumber)s-zcash-gtest.coverage")
-            ),
-            steps.DirectoryUpload(
-                workersrc="./test_bitcoin.coverage",
-                masterdest=util.Interpolate("{{ buildbot_coverage_dir }}/%(prop:buildnumber)s-test_zcash.coverage"),
-                url=util.Interpolate("https://{{ buildbot_host }}/code-coverage/%(prop:buildnumber)s-test_zcash.coverage")
+            sh('make', *tracefiles, name='make coverage tracefiles'),
+            # the tracefiles plus the sources they cover, with paths relative
+            # to the checkout; the master runs genhtml when a report is viewed
+            steps.ShellCommand(
+                command=['sh', '-c',
+                    'sed -i "s|^SF:$PWD/|SF:|" {0}'
+                    ' && sed -n "s/^SF://p" {0} | grep -v "^/" | sort -u'
+                    ' | tar -czf ../coverage.tar.gz {0} -T -'.format(' '.join(tracefiles))],
+                name='pack coverage',
+                haltOnFailure=True,
             ),
-            steps.DirectoryUpload(
-                workersrc="./total.coverage",
-                masterdest=util.Interpolate("{{ buildbot_coverage_dir }}/%(prop:buildnumber)s-total.coverage"),
-                url=util.Interpolate("https://{{ buildbot_host }}/code-coverage/%(prop:buildnumber)s-total.coverage")
+            steps.FileUpload(
+                workersrc='../coverage.tar.gz',
+                masterdest=util.Interpolate(
+                    os.path.join(COVERAGE_DIR, '%(prop:buildnumber)s-coverage.tar.gz')),
+                mode=0o644,
             ),
-            steps.MasterShellCommand("chmod -R 755 {{ buildbot_coverage_dir }}"),
+            AddURLs([
+                (report, util.Interpolate("https://{{ buildbot_host }}/code-coverage/%%(prop:buildnumber)s-%s.coverage" % report))
+                for report in sorted(COVERAGE_REPORTS)
+            ], name='coverage reports'),
         ])
 
 class ZcashValgrindFactory(ZcashBaseFactory):
@@ -324,6 +513,21 @@ class ZcashValgrindFactory(ZcashBaseFactory):
             valgrind('solveequihash', 2, name='valgrind solveequihash 2 threads'),
             valgrind('verifyequihash'),
             valgrind('connectblockslow'),
+            # an extra pass under callgrind records the instruction counts
+            callgrind('parameterloading'),
+            callgrind('createjoinsplit'),
+            callgrind('verifyjoinsplit'),
+            callgrind('solveequihash'),
+            callgrind('solveequihash', 2, name='callgrind solveequihash 2 threads'),
+            callgrind('verifyequihash'),
+            callgrind('connectblockslow'),
+            steps.POST(urllib.parse.urljoin(CODESPEED_URL, '/result/add/json/'),
+                data={'json': getPerfJson},
+                auth=('buildbot', CODESPEED_PASS),
+                verify=CODESPEED_CERT,
+                doStepIf=lambda s: s.getProperty('publish', False),
+                hideStepIf=lambda results, s: results==util.SKIPPED,
+            ),
         ])
 
 class ZcashASanFactory(ZcashBaseFactory):
@@ -341,6 +545,7 @@ class ZcashASanFactory(ZcashBaseFactory):
                 property='llvm-symbolizer',
                 name='Find llvm-symbolizer',
             ),
+            available_memory,
             asan('btest'),
             asan('gtest'),
         ])
@@ -355,11 +560,13 @@ class ZcashTSanFactory(ZcashBaseFactory):
         ZcashBaseFactory.__init__(self)
 
         self.addSteps([
-            test_stage('btest'),
-            test_stage('gtest'),
+            available_memory,
+            tsan('btest'),
+            tsan('gtest'),
         ])
 
 class ZcashCheckDependsFactory(ZcashBaseFactory):
+    share_group = 'default-flags'
     def __init__(self):
         ZcashBaseFactory.__init__(self)
         self.addStep(sh('./qa/zcash/test-depends-sources-mirror.py'))
@@ -82,6 +82,25 @@ def load_webcreds(path):
         return creds
 
 
+def load_impact_rules(path):
+    filedesc = (
+        'A json file with "full_run_branches" and "full_run_paths" arrays and'
+        ' a "steps" object mapping step names to arrays of path patterns')
+    rules = json.loads(read_required_path(path, filedesc))
+    try:
+        for key in ['full_run_branches', 'full_run_paths', 'steps']:
+            rules[key]
+    except KeyError:
+        notify(
+            'There was a format error loading {!r}, which should be: {}',
+            path,
+            filedesc,
+        )
+        raise
+    else:
+        return rules
+
+
 @implementer(IRenderable)
 class GoodRepo:
     def __init__(self, repos, default_repourl):
@@ -0,0 +1,308 @@
+"""
+Database janitor for the master's postgres.
+
+Every step log lives in the `logchunks` table of pg-buildbot, so this prunes
+old logs per builder, recompresses logs that were left uncompressed (e.g. by a
+master restart in the middle of a build), vacuums the largest tables, reports
+how much log data each builder holds, and removes old build artifacts stored
+on the master.
+"""
+
+import fnmatch
+import os
+import time
+
+import sqlalchemy as sa
+from twisted.internet import defer, threads
+
+from buildbot.config import BuilderConfig
+from buildbot.configurators import ConfiguratorBase
+from buildbot.process import buildstep, results
+from buildbot.process.factory import BuildFactory
+from buildbot.schedulers.forcesched import ForceScheduler
+from buildbot.schedulers.timed import Nightly
+from buildbot.worker.local import LocalWorker
+
+JANITOR_NAME = 'zcash-janitor'
+
+def _match_horizon(retention, builder_name, default):
+    for pattern, horizon in retention:
+        if fnmatch.fnmatch(builder_name, pattern):
+            return horizon
+    return default
+
+def _format_bytes(n):
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if abs(n) < 1024:
+            return '%d %s' % (n, unit)
+        n /= 1024.0
+    return '%.1f TiB' % n
+
+class CompressLogs(buildstep.BuildStep):
+    """Compress finished logs which still have raw chunks."""
+    name = 'compress logs'
+
+    def __init__(self, maxLogs=5000, **kwargs):
+        self.maxLogs = maxLogs
+        buildstep.BuildStep.__init__(self, **kwargs)
+
+    def _find_raw_logs(self, conn):
+        model = self.master.db.model
+        q = sa.select([model.logchunks.c.logid]).distinct()
+        q = q.where(model.logchunks.c.logid == model.logs.c.id)
+        q = q.where(model.logs.c.complete == 1)
+        q = q.where(model.logchunks.c.compressed == 0)
+        q = q.limit(self.maxLogs)
+        return [row.logid for row in conn.execute(q)]
+
+    @defer.inlineCallbacks
+    def run(self):
+        logids = yield self.master.db.pool.do(self._find_raw_logs)
+        saved = 0
+        for logid in logids:
+            saved += yield self.master.db.logs.compressLog(logid, force=True)
+        self.descriptionDone = [
+            'compressed', str(len(logids)), 'logs,',
+            'saved', _format_bytes(saved)]
+        defer.returnValue(results.SUCCESS)
+
+class PruneBuilderLogs(buildstep.BuildStep):
+    """Delete log contents of builds older than their builder's horizon.
+
+    `retention` is a list of (builder name pattern, timedelta); the first
+    matching pattern wins and unmatched builders use `defaultHorizon`.
+    """
+    name = 'prune logs'
+
+    def __init__(self, retention, defaultHorizon, **kwargs):
+        self.retention = list(retention)
+        self.defaultHorizon = defaultHorizon
+        buildstep.BuildStep.__init__(self, **kwargs)
+
+    def _prune(self, conn, builderid, older_than):
+        model = self.master.db.model
+        old_logs = sa.select([model.logs.c.id])
+        old_logs = old_logs.where(model.logs.c.stepid == model.steps.c.id)
+        old_logs = old_logs.where(model.steps.c.buildid == model.builds.c.id)
+        old_logs = old_logs.where(model.builds.c.builderid == builderid)
+        old_logs = old_logs.where(model.builds.c.complete_at < older_than)
+
+        # mark the logs deleted first so the UI never shows half a log
+        conn.execute(
+            model.logs.update()
+            .where(model.logs.c.id.in_(old_logs))
+            .where(model.logs.c.type != 'd')
+            .values(type='d'))
+        res = conn.execute(
+            model.logchunks.delete()
+            .where(model.logchunks.c.logid.in_(old_logs)))
+        return res.rowcount
+
+    @defer.inlineCallbacks
+    def run(self):
+        builders = yield self.master.data.get(('builders',))
+        lines = []
+        total = 0
+        for builder in sorted(builders, key=lambda b: b['name']):
+            if builder['name'] == JANITOR_NAME:
+                continue
+            horizon = _match_horizon(
+                self.retention, builder['name'], self.defaultHorizon)
+            older_than = int(time.time() - horizon.total_seconds())
+            deleted = yield self.master.db.pool.do(
+                self._prune, builder['builderid'], older_than)
+            total += deleted
+            lines.append('%s: kept %d days, deleted %d logchunks' % (
+                builder['name'], horizon.days, deleted))
+        yield self.addCompleteLog('retention', '\n'.join(lines) + '\n')
+        self.descriptionDone = ['deleted', str(total), 'logchunks']
+        defer.returnValue(results.SUCCESS)
+
+class VacuumLargestTables(buildstep.BuildStep):
+    """VACUUM ANALYZE the largest tables of the buildbot DB.
+
+    No REINDEX: it locks the table exclusively, and builds still running
+    would stall on their log writes. Plain VACUUM runs alongside them.
+    """
+    name = 'vacuum'
+
+    def __init__(self, count=5, **kwargs):
+        self.count = count
+        buildstep.BuildStep.__init__(self, **kwargs)
+
+    def _vacuum(self, conn):
+        if conn.engine.dialect.name != 'postgresql':
+            return []
+        rows = conn.execute(sa.text(
+            "SELECT relname, pg_total_relation_size(c.oid) AS size"
+            " FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace"
+            " WHERE c.relkind = 'r' AND n.nspname = current_schema()"
+            " ORDER BY size DESC LIMIT :count"), count=self.count).fetchall()
+        # VACUUM refuses to run inside a transaction block
+        conn = conn.execution_options(isolation_level='AUTOCOMMIT')
+        done = []
+        for row in rows:
+            table = conn.dialect.identifier_preparer.quote(row.relname)
+            conn.execute('VACUUM (ANALYZE) %s' % table)
+            after = conn.execute(sa.text(
+                "SELECT pg_total_relation_size(:table)"), table=table).scalar()
+            done.append((row.relname, row.size, after))
+        return done
+
+    @defer.inlineCallbacks
+    def run(self):
+        done = yield self.master.db.pool.do(self._vacuum)
+        if not done:
+            self.descriptionDone = ['skipped (not postgresql)']
+            defer.returnValue(results.SKIPPED)
+        yield self.addCompleteLog('tables', ''.join(
+            '%s: %s -> %s\n' % (name, _format_bytes(before), _format_bytes(after))
+            for name, before, after in done))
+        self.descriptionDone = ['vacuumed', str(len(done)), 'tables']
+        defer.returnValue(results.SUCCESS)
+
+class ReportLogGrowth(buildstep.BuildStep):
+    """Report stored log bytes per builder and the growth since the last run."""
+    name = 'log growth'
+
+    def _sizes(self, conn):
+        model = self.master.db.model
+        q = sa.select([
+            model.builders.c.name,
+            sa.func.sum(sa.func.length(model.logchunks.c.content)),
+        ])
+        q = q.where(model.logchunks.c.logid == model.logs.c.id)
+        q = q.where(model.logs.c.stepid == model.steps.c.id)
+        q = q.where(model.steps.c.buildid == model.builds.c.id)
+        q = q.where(model.builds.c.builderid == model.builders.c.id)
+        q = q.group_by(model.builders.c.name)
+        return {name: int(size or 0) for name, size in conn.execute(q)}
+
+    @defer.inlineCallbacks
+    def run(self):
+        sizes = yield self.master.db.pool.do(self._sizes)
+        objectid = yield self.master.db.state.getObjectId(
+            JANITOR_NAME, self.__class__.__name__)
+        previous = yield self.master.db.state.getState(
+            objectid, 'log_bytes', {})
+        yield self.master.db.state.setState(objectid, 'log_bytes', sizes)
+
+        lines = []
+        for name, size in sorted(sizes.items(), key=lambda i: -i[1]):
+            growth = size - previous.get(name, 0)
+            lines.append('%s: %s (%s%s since last run)' % (
+                name, _format_bytes(size),
+                '+' if growth >= 0 else '-', _format_bytes(abs(growth))))
+        yield self.addCompleteLog('growth', '\n'.join(lines) + '\n')
+        self.setProperty('log_bytes', sizes, 'ReportLogGrowth')
+        self.descriptionDone = [
+            _format_bytes(sum(sizes.values())), 'of logs stored']
+        defer.returnValue(results.SUCCESS)
+
+class PruneArtifacts(buildstep.BuildStep):
+    """Remove files under `path` which are older than `horizon`.
+
+    With `retention`, a list of (builder name pattern, timedelta), every
+    top-level directory under `path` is taken as a builder name and pruned
+    with the horizon of the first matching pattern.
+    """
+    def __init__(self, path, horizon, retention=None, **kwargs):
+        self.path = path
+        self.horizon = horizon
+        self.retention = list(retention) if retention else None
+        kwargs.setdefault('name', 'prune %s' % os.path.basename(path))
+        buildstep.BuildStep.__init__(self, **kwargs)
+
+    def _prune_tree(self, top, horizon):
+        older_than = time.time() - horizon.total_seconds()
+        removed = 0
+        freed = 0
+        for dirpath, dirnames, filenames in os.walk(top, topdown=False):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                st = os.lstat(path)
+                if st.st_mtime < older_than:
+                    os.remove(path)
+                    removed += 1
+                    freed += st.st_size
+            if dirpath != self.path and not os.listdir(dirpath):
+                os.rmdir(dirpath)
+        return removed, freed
+
+    def _prune(self):
+        if not os.path.isdir(self.path):
+            return []
+        if self.retention is None:
+            return [(None, self.horizon) + self._prune_tree(self.path, self.horizon)]
+        done = []
+        for name in sorted(os.listdir(self.path)):
+            top = os.path.join(self.path, name)
+            horizon = _match_horizon(self.retention, name, self.horizon)
+            if os.path.isdir(top) and not os.path.islink(top):
+                done.append((name, horizon) + self._prune_tree(top, horizon))
+            elif os.lstat(top).st_mtime < time.time() - horizon.total_seconds():
+                # stray files next to the builder directories
+                size = os.lstat(top).st_size
+                os.remove(top)
+                done.append((name, horizon, 1, size))
+        return done
+
+    @defer.inlineCallbacks
+    def run(self):
+        # walking a large artifact tree would block the reactor
+        done = yield threads.deferToThread(self._prune)
+        yield self.addCompleteLog('retention', ''.join(
+            '%s: kept %d days, removed %d files, freed %s\n' % (
+                name or self.path, horizon.days, removed, _format_bytes(freed))
+            for name, horizon, removed, freed in done))
+        self.descriptionDone = [
+            'removed', str(sum(d[2] for d in done)), 'artifacts,',
+            'freed', _format_bytes(sum(d[3] for d in done))]
+        defer.returnValue(results.SUCCESS)
+
+class ZcashJanitorConfigurator(ConfiguratorBase):
+    """Adds a nightly janitor builder which keeps the master DB in shape.
+
+    Like buildbot's own JanitorConfigurator, but with per-builder retention:
+    `retention` is a list of (builder name pattern, timedelta). `artifacts`
+    lists the directories on the master to prune, as (path, defaultHorizon)
+    or (path, defaultHorizon, retention) when the directory holds one
+    subdirectory per builder; see PruneArtifacts.
+    """
+    def __init__(self, retention, defaultHorizon, hour=0, vacuumTables=5,
+                 artifacts=(), **kwargs):
+        ConfiguratorBase.__init__(self)
+        self.retention = retention
+        self.defaultHorizon = defaultHorizon
+        self.artifacts = list(artifacts)
+        self.hour = hour
+        self.vacuumTables = vacuumTables
+        self.kwargs = kwargs
+
+    def configure(self, config_dict):
+        ConfiguratorBase.configure(self, config_dict)
+
+        self.schedulers.append(Nightly(
+            name=JANITOR_NAME,
+            builderNames=[JANITOR_NAME],
+            hour=self.hour,
+            **self.kwargs))
+        self.schedulers.append(ForceScheduler(
+            name=JANITOR_NAME + '_force',
+            builderNames=[JANITOR_NAME]))
+
+        factory = BuildFactory([
+            PruneBuilderLogs(self.retention, self.defaultHorizon),
+            CompressLogs(),
+            VacuumLargestTables(self.vacuumTables),
+            ReportLogGrowth(alwaysRun=True),
+        ])
+        for artifact in self.artifacts:
+            factory.addStep(PruneArtifacts(*artifact, alwaysRun=True))
+
+        self.builders.append(BuilderConfig(
+            name=JANITOR_NAME,
+            workername=JANITOR_NAME,
+            factory=factory))
+        self.protocols.setdefault('null', {})
+        self.workers.append(LocalWorker(JANITOR_NAME))
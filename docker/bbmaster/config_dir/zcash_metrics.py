@@ -0,0 +1,131 @@
+"""
+Prometheus metrics for the master, scraped from /metrics on MetricsService's
+port.
+
+Queue waits, step durations and log line counts come from the master's
+message queue, log bytes are counted as the master appends them to the logs;
+provisioning time and CPU/memory use of the latent worker pods are recorded
+by ZcashKubeLatentWorker.
+"""
+
+from prometheus_client import Counter, Gauge, Histogram
+from prometheus_client.twisted import MetricsResource
+from twisted.application import strports
+from twisted.internet import defer
+from twisted.python import log
+from twisted.web import resource, server
+
+from buildbot.util import service
+
+# builds and steps take from seconds to hours
+DURATION_BUCKETS = (
+    1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200, 14400, float('inf'))
+
+QUEUE_WAIT = Histogram(
+    'buildbot_queue_wait_seconds',
+    'Time from build request submission to build start',
+    ['builder'], buckets=DURATION_BUCKETS)
+STEP_DURATION = Histogram(
+    'buildbot_step_duration_seconds',
+    'Duration of finished build steps',
+    ['builder', 'step'], buckets=DURATION_BUCKETS)
+LOG_LINES = Counter(
+    'buildbot_log_lines_total',
+    'Log lines received from workers',
+    ['builder', 'step'])
+LOG_BYTES = Counter(
+    'buildbot_log_bytes_total',
+    'Log bytes received from workers, before compression',
+    ['builder', 'step'])
+LATENT_PROVISIONING = Histogram(
+    'buildbot_latent_provisioning_seconds',
+    'Time from requesting a latent worker until it is attached',
+    ['worker'], buckets=DURATION_BUCKETS)
+WORKER_CPU = Gauge(
+    'buildbot_worker_cpu_cores',
+    'CPU use of a latent worker pod, in cores',
+    ['worker'])
+WORKER_MEMORY = Gauge(
+    'buildbot_worker_memory_bytes',
+    'Memory use of a latent worker pod',
+    ['worker'])
+
+class MetricsService(service.BuildbotService):
+    """Serves the Prometheus metrics and records build and step timings."""
+    name = 'metrics'
+
+    @defer.inlineCallbacks
+    def reconfigService(self, port, **kwargs):
+        root = resource.Resource()
+        root.putChild(b'metrics', MetricsResource())
+        if getattr(self, 'port_service', None) is not None:
+            yield self.port_service.disownServiceParent()
+        self.port_service = strports.service('tcp:%d' % port, server.Site(root))
+        yield self.port_service.setServiceParent(self)
+
+    @defer.inlineCallbacks
+    def startService(self):
+        yield service.BuildbotService.startService(self)
+        self.builder_names = {}
+        self.log_bytes = {}
+        self.consumers = []
+        # count log bytes as they come in: once stored, the logs of a step
+        # are compressed in the background
+        self.updates = self.master.data.updates
+        self.updatesAppendLog = self.updates.appendLog
+        self.updates.appendLog = self.appendLog
+        for callback, path in [
+                (self.buildStarted, ('builds', None, 'new')),
+                (self.stepFinished, ('steps', None, 'finished'))]:
+            consumer = yield self.master.mq.startConsuming(callback, path)
+            self.consumers.append(consumer)
+
+    @defer.inlineCallbacks
+    def stopService(self):
+        for consumer in self.consumers:
+            consumer.stopConsuming()
+        self.consumers = []
+        self.updates.appendLog = self.updatesAppendLog
+        yield service.BuildbotService.stopService(self)
+
+    @defer.inlineCallbacks
+    def getBuilderName(self, builderid):
+        if builderid not in self.builder_names:
+            builder = yield self.master.data.get(('builders', builderid))
+            self.builder_names[builderid] = builder['name']
+        defer.returnValue(self.builder_names[builderid])
+
+    def appendLog(self, logid, content):
+        self.log_bytes[logid] = (
+            self.log_bytes.get(logid, 0) + len(content.encode('utf-8')))
+        return self.updatesAppendLog(logid, content)
+
+    @defer.inlineCallbacks
+    def buildStarted(self, key, build):
+        try:
+            request = yield self.master.data.get(
+                ('buildrequests', build['buildrequestid']))
+            builder = yield self.getBuilderName(build['builderid'])
+            wait = build['started_at'] - request['submitted_at']
+            QUEUE_WAIT.labels(builder).observe(wait.total_seconds())
+        except Exception:
+            log.err(None, 'while recording queue wait')
+
+    @defer.inlineCallbacks
+    def stepFinished(self, key, step):
+        try:
+            build = yield self.master.data.get(('builds', step['buildid']))
+            builder = yield self.getBuilderName(build['builderid'])
+            if step['started_at'] is not None:
+                duration = step['complete_at'] - step['started_at']
+                STEP_DURATION.labels(builder, step['name']).observe(
+                    duration.total_seconds())
+
+            logs = yield self.master.data.get(('steps', step['stepid'], 'logs'))
+            if logs:
+                LOG_LINES.labels(builder, step['name']).inc(
+                    sum(l['num_lines'] for l in logs))
+                LOG_BYTES.labels(builder, step['name']).inc(
+                    sum(self.log_bytes.pop(l['logid'], 0) for l in logs))
+        except Exception:
+            log.err(None, 'while recording step metrics')
@@ -1,11 +1,16 @@
 from datetime import datetime
+import errno
+import fnmatch
 import json
+import os
 import re
+import time
 
 from twisted.internet import defer
 
 from buildbot.plugins import steps, util
 from buildbot.process import buildstep, logobserver, results
+from buildbot.util import asyncSleep
 
 class MergeTestDriver(buildstep.ShellMixin, buildstep.BuildStep):
     driver = './qa/zcash/full_test_suite.py'
@@ -35,18 +40,296 @@ class MergeTestDriver(buildstep.ShellMixin, buildstep.BuildStep):
         # if the command passes extract the list of stages
         result = cmd.results()
         if result == util.SUCCESS:
-            # create a ShellCommand for each stage and add them to the build
+            # create a ShellCommand for each stage and add them to the build,
+            # stages which ChangeImpact found unaffected are shown as skipped
+            skipped = self.getProperty('impact_skipped', {})
             self.build.addStepsAfterCurrentStep([
                 steps.ShellCommand(
                     name=stage,
                     command=[self.driver, stage],
                     env={'PATH': ['${HOME}/venv/bin', '${PATH}']},
                     haltOnFailure=False,
+                    doStepIf=stage not in skipped,
+                    descriptionDone=[stage, skipped[stage]] if stage in skipped else None,
                 ) for stage in self.extract_stages(self.observer.getStdout())
             ])
 
         defer.returnValue(result)
 
+def skipped_by_impact(rules, stages, files):
+    """Return {name: reason} for the steps and stages none of files affect.
+
+    Every stage which runs needs build.sh; stages without a rule always run.
+    """
+    patterns = rules['steps']
+
+    def matching(name):
+        return [f for f in files
+                if any(fnmatch.fnmatch(f, p) for p in patterns[name])]
+
+    run = set()
+    for name in set(patterns) | set(stages):
+        if name not in patterns or matching(name):
+            run.add(name)
+    if run & set(stages):
+        run.add('build.sh')
+
+    return {
+        name: 'unaffected, no changed path matches %s' % ' '.join(patterns[name])
+        for name in set(patterns) | set(stages)
+        if name not in run
+    }
+
+def impacted(name):
+    """doStepIf for a step which ChangeImpact may find unaffected."""
+    def inner(step):
+        return name not in step.getProperty('impact_skipped', {})
+    return inner
+
+class ChangeImpact(MergeTestDriver):
+    """Decide which merge test steps the changes of this build can affect.
+
+    Lists the stages of the test driver and matches the paths changed by the
+    merge commit under test (the PR against its base) against `rules` (see
+    merge_test_impact.json). The steps and stages to skip are stored in the
+    `impact_skipped` property, mapping each name to the reason it was skipped.
+    Builds on one of the `full_run_branches`, with the `full_test_run`
+    property set, or whose revision is not a merge commit run everything.
+    """
+    # the poller only reports the files of commits it had not seen, and none
+    # for homu's merge commit, so the PR's paths are taken from the tree
+    changed_paths_command = (
+        'git rev-parse --verify --quiet HEAD^2 >/dev/null'
+        ' && git diff --name-only HEAD^1 HEAD')
+
+    def __init__(self, rules, **kwargs):
+        MergeTestDriver.__init__(self, **kwargs)
+        self.name = 'change impact'
+        self.rules = rules
+
+    def full_run_reason(self, files):
+        branch = self.getProperty('branch')
+        if branch in self.rules['full_run_branches']:
+            return 'full run on branch %s' % branch
+        if self.getProperty('full_test_run', False):
+            return 'full run requested by the full_test_run property'
+        if files is None:
+            return 'full run, the changed paths of this build are unknown'
+        if not files:
+            return 'full run, no changed paths are known for this build'
+        for f in files:
+            for pattern in self.rules['full_run_paths']:
+                if fnmatch.fnmatch(f, pattern):
+                    return 'full run, %s matches %s' % (f, pattern)
+        return None
+
+    @defer.inlineCallbacks
+    def changed_paths(self):
+        """Return the paths changed by the merge under test, or None."""
+        cmd = yield self.makeRemoteShellCommand(
+            command=self.changed_paths_command,
+            collectStdout=True,
+            stdioLogName='changed paths')
+        yield self.runCommand(cmd)
+        if cmd.results() != util.SUCCESS:
+            defer.returnValue(None)
+        defer.returnValue(sorted(set(
+            f.strip() for f in cmd.stdout.split('\n') if f.strip())))
+
+    @defer.inlineCallbacks
+    def run(self):
+        cmd = yield self.makeRemoteShellCommand()
+        yield self.runCommand(cmd)
+        result = cmd.results()
+        if result != util.SUCCESS:
+            defer.returnValue(result)
+
+        stages = self.extract_stages(self.observer.getStdout())
+        files = yield self.changed_paths()
+        reason = self.full_run_reason(files)
+        if reason:
+            skipped = {}
+            report = [reason]
+        else:
+            skipped = skipped_by_impact(self.rules, stages, files)
+            report = ['changed paths:'] + ['  ' + f for f in files]
+            report += ['%s: %s' % (name, skipped.get(name, 'run'))
+                       for name in sorted(set(self.rules['steps']) | set(stages))]
+        yield self.addCompleteLog('impact', '\n'.join(report) + '\n')
+        self.setProperty('impact_skipped', skipped, 'ChangeImpact')
+        self.descriptionDone = ['skipping', str(len(skipped)), 'steps']
+        defer.returnValue(results.SUCCESS)
+
+    def getResultSummary(self):
+        # ShellMixin would summarize the command instead of descriptionDone
+        return buildstep.BuildStep.getResultSummary(self)
+
+def shared_build_is(mode):
+    """doStepIf for the steps of one side of a shared build."""
+    def inner(step):
+        return step.getProperty('shared_build') == mode
+    return inner
+
+# a waiting build refreshes its marker every pollInterval; older markers are
+# left behind by builds which stopped waiting without removing them
+SHARED_BUILD_WAITER_TIMEOUT = 5*60
+
+def shared_build_waiters(artifact):
+    """Return the number of builds waiting for artifact."""
+    directory, name = os.path.split(artifact)
+    waiting = 0
+    for marker in fnmatch.filter(os.listdir(directory), name + '.wait.*'):
+        try:
+            age = time.time() - os.path.getmtime(os.path.join(directory, marker))
+        except OSError:
+            continue
+        if age < SHARED_BUILD_WAITER_TIMEOUT:
+            waiting += 1
+    return waiting
+
+def shared_build_wanted(step):
+    """doStepIf for packing and uploading a tree another build waits for."""
+    return (step.getProperty('shared_build') == 'upload'
+            and shared_build_waiters(step.getProperty('shared_build_path')) > 0)
+
+class ClaimSharedBuild(buildstep.BuildStep):
+    """Decide whether this build compiles the tree or reuses a shared one.
+
+    Builds with the same `key` (share group, revision, platform and build
+    flags) produce the same tree, so only the first one compiles it; the
+    others wait for it and download its build outputs from `artifacts_dir`.
+    The tree is only uploaded when another build is waiting for it, see
+    shared_build_wanted.
+
+    The claim on a key lasts as long as the build holding it: a build which
+    finds the claiming build finished (e.g. its worker was lost) takes the
+    claim over. After waiting `maxWait` seconds the build compiles the tree
+    itself without sharing it. Sets the `shared_build` property to 'upload',
+    'download' or 'local', and `shared_build_path` to the artifact on the
+    master.
+    """
+    name = 'claim shared build'
+    renderables = ['key']
+
+    def __init__(self, artifacts_dir, key, maxWait=90*60, pollInterval=30, **kwargs):
+        self.artifacts_dir = artifacts_dir
+        self.key = key
+        self.maxWait = maxWait
+        self.pollInterval = pollInterval
+        buildstep.BuildStep.__init__(self, **kwargs)
+
+    @defer.inlineCallbacks
+    def claimIsStale(self, claim):
+        try:
+            with open(claim) as f:
+                buildid = int(f.read().split()[0])
+        except (IOError, OSError, IndexError, ValueError):
+            # unreadable, or being written right now: give it a poll
+            defer.returnValue(time.time() - os.path.getmtime(claim) > self.pollInterval)
+        build = yield self.master.data.get(('builds', buildid))
+        defer.returnValue(build is None or build['complete'])
+
+    @defer.inlineCallbacks
+    def claim(self, artifact):
+        """Return the shared build mode, or None if someone else is building."""
+        if os.path.exists(artifact):
+            defer.returnValue('download')
+        claim = artifact + '.claim'
+        try:
+            fd = os.open(claim, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            try:
+                stale = yield self.claimIsStale(claim)
+                if stale:
+                    os.remove(claim)
+            except OSError:
+                pass
+            defer.returnValue(None)
+        with os.fdopen(fd, 'w') as f:
+            f.write('%d %s #%s\n' % (
+                self.build.buildid,
+                self.getProperty('buildername'), self.getProperty('buildnumber')))
+        defer.returnValue('upload')
+
+    @defer.inlineCallbacks
+    def run(self):
+        if not os.path.isdir(self.artifacts_dir):
+            os.makedirs(self.artifacts_dir)
+        artifact = os.path.join(self.artifacts_dir, '%s.tar.gz' % self.key)
+        self.setProperty('shared_build_path', artifact, 'ClaimSharedBuild')
+
+        waiter = '%s.wait.%d' % (artifact, self.build.buildid)
+        started = time.time()
+        try:
+            mode = yield self.claim(artifact)
+            while mode is None:
+                if time.time() - started > self.maxWait:
+                    mode = 'local'
+                    break
+                # tells the claiming build to upload the tree
+                with open(waiter, 'w'):
+                    pass
+                self.description = ['waiting for shared build', self.key]
+                yield self.updateSummary()
+                yield asyncSleep(self.pollInterval)
+                mode = yield self.claim(artifact)
+        finally:
+            if os.path.exists(waiter):
+                os.remove(waiter)
+
+        self.setProperty('shared_build', mode, 'ClaimSharedBuild')
+        self.descriptionDone = [mode, 'shared build', self.key]
+        defer.returnValue(results.SUCCESS)
+
+class PublishSharedBuild(buildstep.BuildStep):
+    """Publish the uploaded shared build and release the claim on it.
+
+    The upload is published when the steps named in `stepnames` (the ones
+    which compile, pack and upload the tree) succeeded, whatever the result
+    of the rest of the build.
+    """
+    name = 'publish shared build'
+    alwaysRun = True
+
+    def __init__(self, stepnames, **kwargs):
+        self.stepnames = stepnames
+        buildstep.BuildStep.__init__(self, **kwargs)
+
+    def uploaded(self):
+        done = dict((step.name, step.results) for step in self.build.executedSteps)
+        return all(done.get(name) in (results.SUCCESS, results.WARNINGS)
+                   for name in self.stepnames)
+
+    def run(self):
+        artifact = self.getProperty('shared_build_path')
+        partial = artifact + '.partial'
+        if self.uploaded() and os.path.exists(partial):
+            os.rename(partial, artifact)
+            self.descriptionDone = ['published shared build']
+        else:
+            if os.path.exists(partial):
+                os.remove(partial)
+            self.descriptionDone = ['released shared build claim']
+        if os.path.exists(artifact + '.claim'):
+            os.remove(artifact + '.claim')
+        return results.SUCCESS
+
+class AddURLs(buildstep.BuildStep):
+    """Link each (name, url) of urls from the step."""
+    renderables = ['urls']
+
+    def __init__(self, urls, **kwargs):
+        self.urls = urls
+        buildstep.BuildStep.__init__(self, **kwargs)
+
+    @defer.inlineCallbacks
+    def run(self):
+        for name, url in self.urls:
+            yield self.addURL(name, url)
+        defer.returnValue(results.SUCCESS)
+
 class ExpectedFailuresParser(util.LogLineObserver):
     _passed_re = re.compile(r'^\[  PASSED  \] (\d+) test')
     finished = False
@@ -84,24 +367,301 @@ class ExpectedFailuresRunner(buildstep.ShellMixin, buildstep.BuildStep):
         else:
             defer.returnValue(results.FAILURE)
 
-class PerformanceTestRunner(buildstep.ShellMixin, buildstep.BuildStep):
-    def __init__(self, metric, benchmark, args, **kwargs):
+class SanitizerReportParser(util.LogLineObserver):
+    """Collects the sanitizer reports in the output of one test shard."""
+    _start_re = re.compile(r'^(==\d+==ERROR: \w+Sanitizer|WARNING: ThreadSanitizer:)')
+    _summary_re = re.compile(r'^SUMMARY: \w+Sanitizer: ')
+
+    def __init__(self, shard):
+        util.LogLineObserver.__init__(self)
+        self.shard = shard
+        self.report = None
+
+    def outLineReceived(self, line):
+        if self.report is None:
+            if self._start_re.match(line):
+                self.report = [line]
+            return
+        self.report.append(line)
+        if self._summary_re.match(line):
+            self.step.addSanitizerReport(self.shard, self.report)
+            self.report = None
+
+def _normalize_report_line(line):
+    line = re.sub(r'==\d+==', '==PID==', line)
+    line = re.sub(r'\(pid=\d+\)', '(pid=PID)', line)
+    return re.sub(r'0x[0-9a-f]+', '0x...', line)
+
+# (setup, shell command running shard $i of $n) of each test stage. The
+# shards run the stage through full_test_suite.py like the other builders,
+# only selecting their part of the tests; a failing setup fails the step.
+SHARD_COMMANDS = {
+    # split the top-level Boost test suites; test_bitcoin reads
+    # BOOST_TEST_RUN_FILTERS like --run_test
+    'btest': (
+        'suites=$(src/test/test_bitcoin --list_content 2>&1'
+        ' | sed -n "s/^\\([A-Za-z0-9_]*\\)\\*$/\\1/p");'
+        ' [ -n "$suites" ] || { echo "no test suites in test_bitcoin --list_content"; exit 1; };'
+        ' echo "$(echo "$suites" | wc -l) test suites"',
+        'tests=$(echo "$suites"'
+        ' | awk -v n=$n -v i=$i "NR % n == i"'
+        ' | paste -sd: -);'
+        ' [ -z "$tests" ] || BOOST_TEST_RUN_FILTERS="$tests"'
+        ' ./qa/zcash/full_test_suite.py btest'),
+    # zcash-gtest picks its tests from the environment
+    'gtest': (
+        ':',
+        'GTEST_TOTAL_SHARDS=$n GTEST_SHARD_INDEX=$i'
+        ' ./qa/zcash/full_test_suite.py gtest'),
+}
+
+class SanitizerTestShards(buildstep.ShellMixin, buildstep.BuildStep):
+    """Run a test stage of a sanitizer build as parallel shards.
+
+    The number of shards is the worker's `numcpus`, limited by its
+    `available_memory` property (in MiB) at `shard_memory` MiB
+    per shard. Each shard's output is a log of the step. The sanitizer
+    reports of all shards are deduplicated into the 'sanitizer reports' log.
+    """
+    def __init__(self, stage, shard_memory, max_shards=16, **kwargs):
+        self.stage = stage
+        self.shard_memory = shard_memory
+        self.max_shards = max_shards
+        kwargs = self.setupShellMixin(kwargs, prohibitArgs=['command', 'logfiles'])
+        buildstep.BuildStep.__init__(self, **kwargs)
+        self.reports = {}
+
+    def shardCount(self):
+        shards = min(int(self.getProperty('numcpus', 1)), self.max_shards)
+        memory = int(self.getProperty('available_memory', 0) or 0)
+        if memory:
+            shards = min(shards, memory // self.shard_memory)
+        return max(1, shards)
+
+    @defer.inlineCallbacks
+    def run(self):
+        shards = self.shardCount()
+        # the master only creates the logs of self.logfiles
+        self.logfiles = {}
+        for i in range(shards):
+            self.logfiles['shard %d' % i] = '%s-shard-%d.log' % (self.stage, i)
+            self.addLogObserver('shard %d' % i, SanitizerReportParser(i))
+
+        setup, command = SHARD_COMMANDS[self.stage]
+        cmd = yield self.makeRemoteShellCommand(
+            command=['sh', '-c',
+                'n={n}; rm -f {stage}-shard-*; {setup};'
+                ' for i in $(seq 0 $((n - 1))); do'
+                ' {{ ({command}) > {stage}-shard-$i.log 2>&1 < /dev/null;'
+                ' echo $? > {stage}-shard-$i.rc; }} &'
+                ' done; wait; status=0;'
+                ' for i in $(seq 0 $((n - 1))); do'
+                ' rc=$(cat {stage}-shard-$i.rc);'
+                ' echo "shard $i of $n: exit code $rc";'
+                ' [ "$rc" = 0 ] || status=1;'
+                ' done; exit $status'.format(
+                    n=shards, stage=self.stage,
+                    setup=setup, command=command)])
+        yield self.runCommand(cmd)
+        result = cmd.results()
+
+        total = sum(r['count'] for r in self.reports.values())
+        if self.reports:
+            lines = ['%d unique sanitizer reports (%d in total)' % (len(self.reports), total)]
+            for key, report in sorted(self.reports.items()):
+                lines.append('')
+                lines.append('%s (%d times, shards %s)' % (
+                    key, report['count'],
+                    ', '.join(str(s) for s in sorted(report['shards']))))
+                lines.extend(report['lines'])
+            yield self.addCompleteLog('sanitizer reports', '\n'.join(lines) + '\n')
+            result = results.worst_status(result, results.WARNINGS)
+        self.descriptionDone = [
+            self.stage, 'in', str(shards), 'shards,',
+            str(len(self.reports)), 'sanitizer reports']
+        defer.returnValue(result)
+
+    def getResultSummary(self):
+        # ShellMixin would summarize the command instead of descriptionDone
+        return buildstep.BuildStep.getResultSummary(self)
+
+    def addSanitizerReport(self, shard, lines):
+        key = _normalize_report_line(lines[-1].strip())
+        report = self.reports.setdefault(
+            key, {'count': 0, 'shards': set(), 'lines': lines})
+        report['count'] += 1
+        report['shards'].add(shard)
+
+class ReducedLogsMixin(object):
+    """Keeps the bulk of a step's output on the worker.
+
+    `reduced_logs` maps log names to the patterns of the lines which the
+    step's log observers need. With `logs_dir` set and a worker which has the
+    reducedShell command (see docker/common/log_reduction.py), only those lines
+    reach the master while the command runs. The worker compresses the full
+    logs, which are uploaded to `logs_dir` afterwards and linked from the
+    step as `logs_url`. Other workers send everything as usual.
+    """
+    renderables = ['logs_dir', 'logs_url']
+    reduced_logs = {}
+    reducing = False
+
+    def setupReducedLogs(self, kwargs):
+        self.logs_dir = kwargs.pop('logs_dir', None)
+        self.logs_url = kwargs.pop('logs_url', None)
+        return kwargs
+
+    def reducedDir(self):
+        return 'reduced-logs/%s' % re.sub(r'[^\w.-]+', '-', self.name)
+
+    @defer.inlineCallbacks
+    def makeReducedShellCommand(self, **kwargs):
+        cmd = yield self.makeRemoteShellCommand(**kwargs)
+        self.reducing = bool(self.reduced_logs and self.logs_dir is not None
+                             and self.workerVersion('reducedShell'))
+        if self.reducing:
+            cmd.remote_command = 'reducedShell'
+            cmd.args['reduced_logs'] = self.reduced_logs
+            cmd.args['reduced_dir'] = self.reducedDir()
+            stdio = yield self.getLog('stdio')
+            yield stdio.addHeader(
+                'only the lines the step needs are shown for the %s logs,'
+                ' the full logs are uploaded when the command finished\n'
+                % ', '.join(sorted(self.reduced_logs)))
+        defer.returnValue(cmd)
+
+    @defer.inlineCallbacks
+    def uploadReducedLogs(self):
+        if not self.reducing:
+            return
+        uploads = []
+        slug = re.sub(r'[^\w.-]+', '-', self.name)
+        for name in sorted(self.reduced_logs):
+            filename = '%s-%s.log.gz' % (slug, name)
+            url = '%s/%s' % (self.logs_url, filename)
+            yield self.addURL('full %s log' % name, url)
+            uploads.append(steps.FileUpload(
+                workersrc='%s/%s.log.gz' % (self.reducedDir(), name),
+                masterdest=os.path.join(self.logs_dir, filename),
+                mode=0o644,
+                url=url,
+                urlText='full %s log' % name,
+                name='upload %s %s log' % (self.name, name),
+                alwaysRun=True,
+            ))
+        self.build.addStepsAfterCurrentStep(uploads)
+
+FLAMEGRAPH_DIR = '/opt/FlameGraph'
+
+class PerformanceTestRunner(ReducedLogsMixin, buildstep.ShellMixin, buildstep.BuildStep):
+    """Run one benchmark of performance-measurements.sh.
+
+    With the `profile` build property set, the benchmark runs a second time
+    under `perf record` (sampling at `profile_frequency` Hz), its output in
+    the `profiled` log. Results measured under perf are skewed by the
+    sampling, so the performance results come from the first run. The stacks
+    are collapsed on the worker, and the gzipped folded stacks and a
+    flamegraph SVG are uploaded to `profile_dir` and linked from the step as
+    `profile_url`, next to the results they go with.
+
+    Benchmarks with a lot of output declare `reduced_logs`, see
+    ReducedLogsMixin.
+    """
+    renderables = ['profile_dir', 'profile_url']
+    # sampling a benchmark which already runs under valgrind is pointless
+    profilable = True
+    profiling = False
+
+    def __init__(self, metric, benchmark, args, profile_dir=None, profile_url=None, **kwargs):
         self.metric = metric
         self.benchmark = benchmark
         self.args = list(args)
+        self.profile_dir = profile_dir
+        self.profile_url = profile_url
+        kwargs = self.setupReducedLogs(kwargs)
         kwargs = self.setupShellMixin(kwargs, prohibitArgs=['command'])
         buildstep.BuildStep.__init__(self, **kwargs)
 
     @defer.inlineCallbacks
     def run(self):
+        command = [
+            './qa/zcash/performance-measurements.sh',
+            self.metric,
+            self.benchmark,
+        ]+self.args
+        cmd = yield self.makeReducedShellCommand(command=command)
+        yield self.runCommand(cmd)
+        yield self.uploadReducedLogs()
+        result = cmd.results()
+
+        self.profiling = (self.profilable and self.profile_dir is not None
+                          and self.getProperty('profile', False))
+        if self.profiling and result == results.SUCCESS:
+            profiled = yield self.profile(command)
+            result = results.worst_status(result, profiled)
+        defer.returnValue(result)
+
+    def getResultSummary(self):
+        summary = buildstep.ShellMixin.getResultSummary(self)
+        if self.profiling:
+            summary['step'] += ' (profiled)'
+        return summary
+
+    def profileFile(self, suffix):
+        return 'profile-%s.%s' % (re.sub(r'[^\w.-]+', '-', self.name), suffix)
+
+    @defer.inlineCallbacks
+    def profile(self, command):
+        """Run command under perf and upload its flamegraph."""
+        # a separate log, so the result parsers only see the first run
         cmd = yield self.makeRemoteShellCommand(
+            stdioLogName='profiled',
             command=[
-                './qa/zcash/performance-measurements.sh',
-                self.metric,
-                self.benchmark,
-            ]+self.args)
+                'perf', 'record', '-g',
+                '-F', str(self.getProperty('profile_frequency', 99)),
+                '-o', self.profileFile('perf.data'),
+                '--',
+            ]+command)
         yield self.runCommand(cmd)
-        defer.returnValue(cmd.results())
+        if cmd.results() != results.SUCCESS:
+            defer.returnValue(results.WARNINGS)
+        result = yield self.collectProfile()
+        defer.returnValue(result)
+
+    @defer.inlineCallbacks
+    def collectProfile(self):
+        cmd = yield self.makeRemoteShellCommand(
+            stdioLogName='profile',
+            command=['sh', '-c',
+                'perf script -i {data}'
+                ' | {fg}/stackcollapse-perf.pl > {folded}'
+                ' && {fg}/flamegraph.pl --title "{title}" {folded} > {svg}'
+                ' && gzip -f {folded}'.format(
+                    data=self.profileFile('perf.data'),
+                    folded=self.profileFile('folded'),
+                    svg=self.profileFile('svg'),
+                    title=self.name,
+                    fg=FLAMEGRAPH_DIR)])
+        yield self.runCommand(cmd)
+        if cmd.results() != results.SUCCESS:
+            defer.returnValue(results.WARNINGS)
+
+        uploads = []
+        for suffix, text in [('svg', 'flamegraph'), ('folded.gz', 'folded stacks')]:
+            filename = self.profileFile(suffix)
+            masterdest = os.path.join(self.profile_dir, filename)
+            url = '%s/%s' % (self.profile_url, filename)
+            yield self.addURL(text, url)
+            uploads.append(steps.FileUpload(
+                workersrc=filename,
+                masterdest=masterdest,
+                mode=0o644,
+                url=url,
+                urlText=text,
+                name='upload %s %s' % (self.name, text),
+            ))
+        self.build.addStepsAfterCurrentStep(uploads)
+        defer.returnValue(results.SUCCESS)
 
     def get_base_fields(self):
         return {
@@ -243,6 +803,12 @@ class MemoryParser(util.LogLineObserver):
                 self.step.setData(int(total.replace(',', '')))
 
 class MemoryTestRunner(PerformanceTestRunner):
+    profilable = False
+    # the massif output is mostly heap trees
+    reduced_logs = {
+        'stdio': [MemoryParser._info_re.pattern, MemoryParser._snapshot_re.pattern],
+    }
+
     def __init__(self, benchmark, args, **kwargs):
         PerformanceTestRunner.__init__(self, 'memory', benchmark, args, **kwargs)
         self.addLogObserver('stdio', MemoryParser())
@@ -254,6 +820,239 @@ class MemoryTestRunner(PerformanceTestRunner):
             'result_value': data,
         }
 
+class MemcheckParser(util.LogLineObserver):
+    """Collect memcheck's error count and definitely lost bytes."""
+    _errors_re = re.compile(r'ERROR SUMMARY: ([\d,]+) errors from')
+    _lost_re = re.compile(r'definitely lost: ([\d,]+) bytes in')
+
+    def __init__(self):
+        util.LogLineObserver.__init__(self)
+        self.errors = None
+        self.lost = 0
+
+    def outLineReceived(self, line):
+        m = self._errors_re.search(line)
+        if m:
+            self.errors = int(m.group(1).replace(',', ''))
+            return
+        m = self._lost_re.search(line)
+        if m:
+            self.lost = int(m.group(1).replace(',', ''))
+
+    errLineReceived = outLineReceived
+
+class ValgrindTestRunner(PerformanceTestRunner):
+    """Run a benchmark under memcheck, as performance-measurements.sh does.
+
+    The step warns when memcheck reports errors or definitely lost memory.
+    """
+    profilable = False
+    # the leak records are in the full log; the step needs the summaries
+    reduced_logs = {
+        'stdio': [
+            r'HEAP SUMMARY',
+            r'in use at exit',
+            r'total heap usage',
+            r'LEAK SUMMARY',
+            r'(definitely|indirectly|possibly) lost',
+            r'still reachable',
+            r'ERROR SUMMARY',
+        ],
+    }
+
+    def __init__(self, benchmark, args, **kwargs):
+        PerformanceTestRunner.__init__(self, 'valgrind', benchmark, args, **kwargs)
+        self.memcheck = MemcheckParser()
+        self.addLogObserver('stdio', self.memcheck)
+
+    @defer.inlineCallbacks
+    def run(self):
+        result = yield PerformanceTestRunner.run(self)
+        if self.memcheck.errors or self.memcheck.lost:
+            result = results.worst_status(result, results.WARNINGS)
+        defer.returnValue(result)
+
+    def getResultSummary(self):
+        summary = PerformanceTestRunner.getResultSummary(self)
+        if self.memcheck.errors is not None:
+            summary['step'] += ' (%d errors, %d bytes definitely lost)' % (
+                self.memcheck.errors, self.memcheck.lost)
+        return summary
+
+class CallgrindParser(util.LogLineObserver):
+    """Parse `callgrind_annotate` output.
+
+    Collects the program's total instruction count and the first `top`
+    functions, which callgrind_annotate sorts by exclusive cost. Functions
+    are named without their source file, whose path depends on the worker.
+    Exclusive cost keeps runtime frames like `_start` or `main` out of the
+    list, and frames without a symbol (`???:0x...`) are skipped, as their
+    addresses are not comparable between builds.
+    """
+    _total_re = re.compile(r'^([\d,]+)\s+(?:\([\d.]+%\)\s+)?PROGRAM TOTALS')
+    _function_re = re.compile(r'^([\d,]+)\s+(?:\([\d.]+%\)\s+)?(.+?)(?:\s+\[[^\]]*\])?$')
+
+    def __init__(self, top):
+        util.LogLineObserver.__init__(self)
+        self.top = top
+        self.total = None
+        self.functions = []
+        self.parsing = False
+
+    def outLineReceived(self, line):
+        line = line.strip()
+        if self.total is None:
+            m = self._total_re.match(line)
+            if m:
+                self.total = int(m.group(1).replace(',', ''))
+            return
+
+        # the function list follows its `Ir  file:function` header
+        if not self.parsing:
+            self.parsing = line.endswith('file:function')
+            return
+
+        if len(self.functions) < self.top:
+            m = self._function_re.match(line)
+            if m:
+                function = m.group(2).split(':', 1)[-1]
+                if function.startswith('0x'):
+                    return
+                self.functions.append((function, int(m.group(1).replace(',', ''))))
+
+class CallgrindTestRunner(PerformanceTestRunner):
+    """Record the callgrind instruction counts of a benchmark.
+
+    performance-measurements.sh starts zcashd under memcheck; the step puts a
+    `valgrind` wrapper first in its PATH which runs callgrind instead, so
+    this is an extra pass next to the memcheck step of the same benchmark.
+    The program's total instruction count and the exclusive cost of the
+    `top` most expensive functions are recorded as performance results, and
+    compared with the previous run of the same step on this builder.
+
+    Instruction counts barely change between runs of the same revision, but
+    they are not exact (RPC polling, thread scheduling), so the step only
+    warns when one grows by more than `tolerance`.
+    """
+    profilable = False
+    # the log of callgrind itself; the counts come from callgrind_annotate
+    reduced_logs = {
+        'stdio': [r'Collected : \d+'],
+    }
+    top = 10
+    tolerance = 0.01
+    # Codespeed's limit on benchmark names
+    max_name_length = 100
+
+    wrapper = """#!/bin/sh
+# run under callgrind instead of memcheck, without memcheck's options
+for a; do
+    shift
+    case "$a" in
+        --leak-check=*|--error-limit=*) ;;
+        *) set -- "$@" "$a" ;;
+    esac
+done
+exec "$REAL_VALGRIND" --tool=callgrind --callgrind-out-file="$CALLGRIND_OUT" "$@"
+"""
+
+    def __init__(self, benchmark, args, top=None, tolerance=None, **kwargs):
+        PerformanceTestRunner.__init__(self, 'valgrind', benchmark, args, **kwargs)
+        if top is not None:
+            self.top = top
+        if tolerance is not None:
+            self.tolerance = tolerance
+        self.callgrind = CallgrindParser(self.top)
+        self.addLogObserver('callgrind', self.callgrind)
+
+    def callgrindFile(self, suffix):
+        return 'callgrind-%s.%s' % (re.sub(r'[^\w.-]+', '-', self.name), suffix)
+
+    @defer.inlineCallbacks
+    def makeReducedShellCommand(self, command, **kwargs):
+        wrapper_dir = self.callgrindFile('bin')
+        command = ['sh', '-c',
+            'mkdir -p {dir}'
+            ' && cat > {dir}/valgrind <<"EOF"'
+            ' && chmod +x {dir}/valgrind'
+            ' && REAL_VALGRIND="$(command -v valgrind)"'
+            ' && CALLGRIND_OUT="$PWD/{out}"'
+            ' && PATH="$PWD/{dir}:$PATH"'
+            ' && export REAL_VALGRIND CALLGRIND_OUT PATH'
+            ' && exec "$@"\n{wrapper}EOF\n'.format(
+                dir=wrapper_dir,
+                wrapper=self.wrapper,
+                out=self.callgrindFile('out')),
+            'sh']+command
+        cmd = yield PerformanceTestRunner.makeReducedShellCommand(
+            self, command=command, **kwargs)
+        defer.returnValue(cmd)
+
+    @defer.inlineCallbacks
+    def run(self):
+        result = yield PerformanceTestRunner.run(self)
+        if result != results.SUCCESS:
+            defer.returnValue(result)
+
+        cmd = yield self.makeRemoteShellCommand(
+            stdioLogName='callgrind',
+            command=['callgrind_annotate', self.callgrindFile('out')])
+        yield self.runCommand(cmd)
+        if cmd.results() != results.SUCCESS or self.callgrind.total is None:
+            defer.returnValue(results.worst_status(result, results.WARNINGS))
+
+        data = [('total', self.callgrind.total)] + self.callgrind.functions
+        for item in data:
+            self.setData(item)
+
+        comparison = yield self.compareWithPrevious(dict(data))
+        defer.returnValue(results.worst_status(result, comparison))
+
+    def parseData(self, data):
+        name, value = data
+        if name == 'total':
+            benchmark = self.name
+            units_title = 'Instructions'
+        else:
+            benchmark = '%s %s' % (self.name, name)
+            units_title = 'Exclusive instructions'
+        return {
+            'benchmark': benchmark[:self.max_name_length],
+            'units_title': units_title,
+            'units': 'Ir',
+            'result_value': value,
+        }
+
+    @defer.inlineCallbacks
+    def compareWithPrevious(self, data):
+        """Store data; warn if a count grew by more than the tolerance."""
+        objectid = yield self.master.db.state.getObjectId(
+            self.getProperty('buildername'), self.__class__.__name__)
+        previous = yield self.master.db.state.getState(objectid, self.name, None)
+        yield self.master.db.state.setState(objectid, self.name, {
+            'revision': self.getProperty('got_revision'),
+            'data': data,
+        })
+        if previous is None:
+            defer.returnValue(results.SUCCESS)
+
+        lines = ['compared with %s, tolerance %.1f%%' % (
+            previous['revision'], self.tolerance * 100)]
+        grew = []
+        for name, value in sorted(data.items()):
+            before = previous['data'].get(name)
+            if not before:
+                continue
+            change = float(value - before) / before
+            flag = ''
+            if change > self.tolerance:
+                grew.append(name)
+                flag = '  grew'
+            lines.append('%s: %d -> %d (%+.2f%%)%s' % (
+                name, before, value, change * 100, flag))
+        yield self.addCompleteLog('comparison', '\n'.join(lines) + '\n')
+        defer.returnValue(results.WARNINGS if grew else results.SUCCESS)
+
 class InitialBlockDownloadTimeParser(util.LogLineObserver):
     _start_re = re.compile(r'^([\d-]+ [\d:]+) Zcash version')
     _end_re = re.compile(r'^([\d-]+ [\d:]+) Leaving InitialBlockDownload')
@@ -281,11 +1080,19 @@ class InitialBlockDownloadTimeParser(util.LogLineObserver):
                 (end - self.start).total_seconds())
             self.step.stopZcash()
 
-class InitialBlockDownloadTimeRunner(buildstep.ShellMixin, buildstep.BuildStep):
+class InitialBlockDownloadTimeRunner(ReducedLogsMixin, buildstep.ShellMixin, buildstep.BuildStep):
+    reduced_logs = {
+        'debug': [
+            InitialBlockDownloadTimeParser._start_re.pattern,
+            InitialBlockDownloadTimeParser._end_re.pattern,
+        ],
+    }
+
     def __init__(self, datadir, **kwargs):
         self.datadir = datadir
         kwargs['logfiles'] = {'debug': '%s/debug.log' % datadir}
         kwargs['sigtermTime'] = 30
+        kwargs = self.setupReducedLogs(kwargs)
         kwargs = self.setupShellMixin(kwargs, prohibitArgs=['command'])
         buildstep.BuildStep.__init__(self, **kwargs)
         self.addLogObserver('debug', InitialBlockDownloadTimeParser())
@@ -293,9 +1100,10 @@ class InitialBlockDownloadTimeRunner(buildstep.ShellMixin, buildstep.BuildStep):
 
     @defer.inlineCallbacks
     def run(self):
-        cmd = yield self.makeRemoteShellCommand(
+        cmd = yield self.makeReducedShellCommand(
             command=['./src/zcashd', '-datadir=%s' % self.datadir])
         yield self.runCommand(cmd)
+        yield self.uploadReducedLogs()
         if self.stopZcashCalled:
             defer.returnValue(results.SUCCESS)
         else:
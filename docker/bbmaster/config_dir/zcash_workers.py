@@ -1,4 +1,16 @@
-from buildbot.plugins import worker
+import fnmatch
+import time
+
+from twisted.internet import defer, task
+from twisted.python import log
+
+from buildbot.plugins import util, worker
+
+from zcash_metrics import (
+    LATENT_PROVISIONING,
+    WORKER_CPU,
+    WORKER_MEMORY,
+)
 
 """   
 - name: memory-demo-ctr
@@ -9,7 +21,89 @@ from buildbot.plugins import worker
       requests:
         memory: "100Mi" """
 
-class ZcashBaseKubeLatentWorker(worker.KubeLatentWorker):
+# (branch pattern, image tag) of the prebaked worker images built by
+# docker/prebaked/build-images.sh, first match wins. Keep in sync with
+# docker/prebaked/release-lines.
+RELEASE_LINES = [
+    ('hotfix-v2.0*', 'v2.0'),
+    ('v2.0*', 'v2.0'),
+    ('*', 'master'),
+]
+
+def prebaked_image(repository):
+    """Render the prebaked worker image matching the build's branch."""
+    @util.renderer
+    def inner(props):
+        branch = props.getProperty('branch') or 'master'
+        for pattern, tag in RELEASE_LINES:
+            if fnmatch.fnmatch(branch, pattern):
+                return '%s:%s' % (repository, tag)
+        return '%s:latest' % repository
+    return inner
+
+_cpu_units = {'n': 1e-9, 'u': 1e-6, 'm': 1e-3}
+_memory_units = {'Ki': 2**10, 'Mi': 2**20, 'Gi': 2**30, 'K': 1e3, 'M': 1e6, 'G': 1e9}
+
+def parse_quantity(quantity, units):
+    """Parse a kubernetes resource quantity such as '250m' or '512Mi'."""
+    for suffix, scale in units.items():
+        if quantity.endswith(suffix):
+            return float(quantity[:-len(suffix)]) * scale
+    return float(quantity)
+
+class ZcashKubeLatentWorker(worker.KubeLatentWorker):
+    """KubeLatentWorker which records its provisioning time and pod usage."""
+    # how often the pod's resource use is read from the metrics API
+    usage_interval = 30
+
+    def substantiate(self, wfb, build):
+        started = time.time()
+        provisioning = not self.substantiated
+        d = worker.KubeLatentWorker.substantiate(self, wfb, build)
+
+        @d.addCallback
+        def substantiated(res):
+            if res and provisioning:
+                LATENT_PROVISIONING.labels(self.name).observe(time.time() - started)
+                self.startUsagePolling()
+            return res
+        return d
+
+    def startUsagePolling(self):
+        if getattr(self, 'usage_loop', None) is None:
+            self.usage_loop = task.LoopingCall(self.recordUsage)
+            self.usage_loop.start(self.usage_interval, now=False)
+
+    def stopUsagePolling(self):
+        if getattr(self, 'usage_loop', None) is not None:
+            self.usage_loop.stop()
+            self.usage_loop = None
+        WORKER_CPU.labels(self.name).set(0)
+        WORKER_MEMORY.labels(self.name).set(0)
+
+    @defer.inlineCallbacks
+    def recordUsage(self):
+        try:
+            res = yield self._kube.get(
+                '/apis/metrics.k8s.io/v1beta1/namespaces/%s/pods/%s' % (
+                    self.namespace, self.getContainerName()))
+            if res.code != 200:
+                return
+            usage = yield res.json()
+            cpu = memory = 0
+            for container in usage['containers']:
+                cpu += parse_quantity(container['usage']['cpu'], _cpu_units)
+                memory += parse_quantity(container['usage']['memory'], _memory_units)
+            WORKER_CPU.labels(self.name).set(cpu)
+            WORKER_MEMORY.labels(self.name).set(memory)
+        except Exception:
+            log.err(None, 'while reading pod metrics of %s' % self.name)
+
+    def stop_instance(self, fast=False, reportFailure=True):
+        self.stopUsagePolling()
+        return worker.KubeLatentWorker.stop_instance(self, fast, reportFailure)
+
+class ZcashBaseKubeLatentWorker(ZcashKubeLatentWorker):
     def getBuildContainerResources(self, build):
         resources = {
                 "limits": {
@@ -18,4 +112,4 @@ class ZcashBaseKubeLatentWorker(worker.KubeLatentWorker):
                 "requests": {
                     "memory": "20Gi",
                 }}
-        return resources
\ No newline at end of file
+        return resources
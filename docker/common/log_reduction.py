@@ -0,0 +1,134 @@
+"""
+Worker side of log reduction.
+
+The reducedShell command runs a shell command like the usual shell command,
+but for each log named in its `reduced_logs` argument only the lines which
+match one of the given patterns are sent to the master. The full log is
+written gzipped to `<reduced_dir>/<log name>.log.gz`, which the master uploads
+once the step finished. Patterns are searched for in each line, without its
+surrounding whitespace.
+"""
+
+import gzip
+import os
+import re
+
+from buildbot_worker import runprocess
+from buildbot_worker.commands import registry
+from buildbot_worker.commands.shell import WorkerShellCommand
+
+class ReducedLog(object):
+    def __init__(self, path, patterns):
+        self.patterns = [re.compile(p) for p in patterns]
+        self.archive = gzip.open(path, 'wb')
+        # stdout and stderr share the stdio log, but not their partial lines
+        self.partial = {}
+
+    def filter(self, stream, data):
+        """Archive data; return its complete lines which match a pattern."""
+        self.archive.write(data.encode('utf-8') if not isinstance(data, bytes) else data)
+        lines = (self.partial.get(stream, '') + data).split('\n')
+        self.partial[stream] = lines.pop()
+        return ''.join(line + '\n' for line in lines if self.matches(line))
+
+    def matches(self, line):
+        line = line.strip()
+        return any(p.search(line) for p in self.patterns)
+
+    def close(self):
+        """Close the archive; return the last line of each stream which matches."""
+        self.archive.close()
+        partial, self.partial = self.partial, {}
+        return [(stream, line) for stream, line in sorted(partial.items())
+                if line and self.matches(line)]
+
+class ReducingRunProcess(runprocess.RunProcess):
+    def __init__(self, builder, command, workdir, reduced_logs, reduced_dir, **kwargs):
+        runprocess.RunProcess.__init__(self, builder, command, workdir, **kwargs)
+        reduced_dir = os.path.join(workdir, reduced_dir)
+        if not os.path.isdir(reduced_dir):
+            os.makedirs(reduced_dir)
+        self.reduced = {}
+        for name, patterns in reduced_logs.items():
+            self.reduced[name] = ReducedLog(
+                os.path.join(reduced_dir, '%s.log.gz' % name), patterns)
+
+    def reduce(self, name, stream, data):
+        if name not in self.reduced:
+            return data
+        data = self.reduced[name].filter(stream, data)
+        # output which is kept on the worker still shows the command is alive
+        if not data and self.ioTimeoutTimer:
+            self.ioTimeoutTimer.reset(self.timeout)
+        return data
+
+    def addStdout(self, data):
+        data = self.reduce('stdio', 'stdout', data)
+        if data:
+            runprocess.RunProcess.addStdout(self, data)
+
+    def addStderr(self, data):
+        data = self.reduce('stdio', 'stderr', data)
+        if data:
+            runprocess.RunProcess.addStderr(self, data)
+
+    def addLogfile(self, name, data):
+        data = self.reduce(name, name, data)
+        if data:
+            runprocess.RunProcess.addLogfile(self, name, data)
+
+    def closeReducedLogs(self):
+        reduced, self.reduced = self.reduced, {}
+        for name, log in reduced.items():
+            for stream, data in log.close():
+                if stream == 'stdout':
+                    runprocess.RunProcess.addStdout(self, data)
+                elif stream == 'stderr':
+                    runprocess.RunProcess.addStderr(self, data)
+                else:
+                    runprocess.RunProcess.addLogfile(self, name, data)
+
+    def finished(self, sig, rc):
+        # pick up what the command wrote last before the archives are closed
+        for w in self.logFileWatchers:
+            w.poll()
+        self.closeReducedLogs()
+        runprocess.RunProcess.finished(self, sig, rc)
+
+    def failed(self, why):
+        self.closeReducedLogs()
+        runprocess.RunProcess.failed(self, why)
+
+class ReducedShellCommand(WorkerShellCommand):
+    requiredArgs = ['workdir', 'command', 'reduced_logs', 'reduced_dir']
+
+    def start(self):
+        args = self.args
+        workdir = os.path.join(self.builder.basedir, args['workdir'])
+
+        c = ReducingRunProcess(
+            self.builder,
+            args['command'],
+            workdir,
+            args['reduced_logs'],
+            args['reduced_dir'],
+            environ=args.get('env'),
+            timeout=args.get('timeout', None),
+            maxTime=args.get('maxTime', None),
+            sigtermTime=args.get('sigtermTime', None),
+            sendStdout=args.get('want_stdout', True),
+            sendStderr=args.get('want_stderr', True),
+            sendRC=True,
+            initialStdin=args.get('initial_stdin'),
+            logfiles=args.get('logfiles', {}),
+            usePTY=args.get('usePTY', False),
+            logEnviron=args.get('logEnviron', True),
+        )
+        if args.get('interruptSignal'):
+            c.interruptSignal = args['interruptSignal']
+        c._reactor = self._reactor
+        self.command = c
+        return self.command.start()
+
+def install():
+    registry.commandRegistry['reducedShell'] = ReducedShellCommand
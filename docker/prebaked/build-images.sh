@@ -0,0 +1,90 @@
+#!/usr/bin/env bash
+#
+# Build and push the prebaked worker images, one per platform and release
+# line, and record their size and pull time.
+#
+# Usage: build-images.sh [platform...]    (default: debian9 ubuntu1604)
+#
+# Environment:
+#   REGISTRY    image registry (default: gcr.io/uplifted-plate-210520)
+#   ZCASH_REPO  zcash git repository (default: https://github.com/zcash/zcash.git)
+#   STATS_FILE  CSV the image stats are appended to (default: image-stats.csv)
+
+set -eu -o pipefail
+
+HERE="$(cd "$(dirname "$0")" && pwd)"
+REGISTRY="${REGISTRY:-gcr.io/uplifted-plate-210520}"
+ZCASH_REPO="${ZCASH_REPO:-https://github.com/zcash/zcash.git}"
+STATS_FILE="${STATS_FILE:-image-stats.csv}"
+PLATFORMS=("$@")
+if [ "${#PLATFORMS[@]}" -eq 0 ]; then
+    PLATFORMS=(debian9 ubuntu1604)
+fi
+
+WORK="$(mktemp -d)"
+trap 'rm -rf "$WORK"' EXIT
+
+git clone --bare --quiet "$ZCASH_REPO" "$WORK/zcash.git"
+
+if [ ! -f "$STATS_FILE" ]; then
+    echo "date,image,depends_tree,size_bytes,pull_seconds" > "$STATS_FILE"
+fi
+
+for platform in "${PLATFORMS[@]}"; do
+    base="$REGISTRY/bbworker-$platform"
+
+    # The plain worker image is the bottom layer of every release line
+    # built from docker/, the worker images share docker/common
+    docker build --pull -t "$base:latest" -f "$HERE/../$platform/Dockerfile" "$HERE/.."
+    docker push "$base:latest"
+
+    grep -v '^#' "$HERE/release-lines" | while read -r tag ref; do
+        [ -n "$tag" ] || continue
+        image="$base:$tag"
+        context="$WORK/$platform-$tag"
+        mkdir -p "$context"
+        git --git-dir="$WORK/zcash.git" archive "$ref" depends zcutil/fetch-params.sh \
+            | tar -x -C "$context"
+        depends_tree="$(git --git-dir="$WORK/zcash.git" rev-parse "$ref:depends")"
+
+        # The Rust toolchain recipe is rust.mk, but its package is `rust` on
+        # some release lines and `native_rust` on others
+        rust_package="$(sed -n 's/^package=//p' "$context/depends/packages/rust.mk" 2>/dev/null || true)"
+        if [ -z "$rust_package" ]; then
+            echo "$ref: no Rust toolchain package in depends/packages/rust.mk" >&2
+            exit 1
+        fi
+
+        # depends/ without the recipes of the other packages, for the Rust
+        # toolchain layers: unchanged by a bump of any other package
+        cp -a "$context/depends" "$context/depends-rust"
+        find "$context/depends-rust/packages" -name '*.mk' \
+            ! -name packages.mk ! -name rust.mk -delete
+        find "$context/depends-rust/patches" -mindepth 1 -maxdepth 1 \
+            ! -name rust -exec rm -rf {} +
+
+        # --cache-from only uses images which are present locally
+        docker pull --quiet "$image" > /dev/null 2>&1 || true
+
+        docker build \
+            --build-arg BASE_IMAGE="$base:latest" \
+            --build-arg RUST_PACKAGE="$rust_package" \
+            --cache-from "$image" \
+            -t "$image" \
+            -f "$HERE/Dockerfile" \
+            "$context"
+        docker push "$image"
+
+        # The base image stays local, so this is the pull time of a node
+        # which already has the plain worker image cached.
+        size="$(docker image inspect --format '{{.Size}}' "$image")"
+        docker image rm "$image" > /dev/null
+        start="$(date +%s.%N)"
+        docker pull --quiet "$image" > /dev/null
+        end="$(date +%s.%N)"
+        pull="$(echo "$end - $start" | bc)"
+
+        echo "$(date -u +%Y-%m-%dT%H:%M:%SZ),$image,$depends_tree,$size,$pull" >> "$STATS_FILE"
+        echo "$image: $size bytes, pulled in ${pull}s"
+    done
+done
@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+"""
+Load test driver for the master configuration, see README.md.
+
+    render    fill in the deployment template variables of the config modules
+    record    save the step output of finished builds for the replay workers
+    drive     force builds on a running load test master and measure it
+    sink      accept the results which the benchmarks post to Codespeed
+"""
+
+import argparse
+import fnmatch
+import glob
+import gzip
+import http.server
+import json
+import os
+import re
+import sys
+import time
+import urllib.request
+
+import jinja2
+import sqlalchemy as sa
+
+def api(url, path, data=None):
+    if data is not None:
+        data = json.dumps(data).encode('utf8')
+    request = urllib.request.Request(
+        url.rstrip('/') + '/api/v2/' + path, data=data,
+        headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read().decode('utf8'))
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+####### render
+
+def render(args):
+    with open(args.vars) as f:
+        variables = json.load(f)
+    for setting in args.set:
+        name, _, value = setting.partition('=')
+        variables[name] = value
+    for path in args.files:
+        with open(path) as f:
+            template = jinja2.Template(f.read(), undefined=jinja2.StrictUndefined)
+        rendered = template.render(**variables)
+        with open(path, 'w') as f:
+            f.write(rendered)
+
+####### record
+
+def split_commands(content):
+    """Split a stdio log into (display, lines, rc, elapsed) per command."""
+    lines = content.splitlines(True)
+    commands = []
+    for i, line in enumerate(lines):
+        # every command starts with its command line, then ' in dir ...'
+        if line.startswith('h in dir ') and i > 0 and lines[i - 1][0] == 'h':
+            commands.append([lines[i - 1][1:].rstrip('\n'), [], 0, 0])
+        elif commands:
+            commands[-1][1].append(line)
+            m = re.match(r'h(?:program finished with exit code |using fake rc=)(-?\d+)', line)
+            if m:
+                commands[-1][2] = int(m.group(1))
+            m = re.match(r'helapsedTime=([\d.]+)', line)
+            if m:
+                commands[-1][3] = float(m.group(1))
+    return commands
+
+def save(path, lines):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with gzip.open(path, 'wt', encoding='utf-8') as f:
+        f.writelines(lines)
+    return sum(len(line) - 1 for line in lines if line[0] != 'h')
+
+def log_contents(url, logid):
+    return ''.join(chunk['content'] for chunk in
+                   api(url, 'logs/%d/contents' % logid)['logchunks'])
+
+def record(args):
+    os.makedirs(args.out, exist_ok=True)
+    manifest_path = os.path.join(args.out, 'manifest.json')
+    manifest = {'commands': []}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    known = set((e['builder'], e['match']) for e in manifest['commands'])
+
+    for spec in args.builds:
+        builder_name, _, number = spec.rpartition('/')
+        builder = api(args.master, 'builders?name=%s' % builder_name)['builders'][0]
+        build = api(args.master, 'builders/%d/builds/%s' % (
+            builder['builderid'], number))['builds'][0]
+        for step in api(args.master, 'builds/%d/steps' % build['buildid'])['steps']:
+            logs = api(args.master, 'steps/%d/logs' % step['stepid'])['logs']
+            stdio = [l for l in logs if l['slug'] == 'stdio']
+            if not stdio:
+                continue
+            commands = split_commands(log_contents(args.master, stdio[0]['logid']))
+            for n, (display, lines, rc, elapsed) in enumerate(commands):
+                entry = {
+                    'builder': builder_name,
+                    'match': glob.escape(display),
+                    'rc': rc,
+                    'elapsed': elapsed,
+                    'logfiles': {},
+                }
+                if (builder_name, entry['match']) in known:
+                    continue
+                known.add((builder_name, entry['match']))
+                prefix = os.path.join(builder_name, '%d-%d' % (step['number'], n))
+                entry['stdio'] = prefix + '-stdio.log.gz'
+                entry['bytes'] = save(os.path.join(args.out, entry['stdio']), lines)
+                # logfiles are watched by the step's (last) shell command
+                if n == len(commands) - 1:
+                    for l in logs:
+                        if l['slug'] == 'stdio' or l['type'] != 's':
+                            continue
+                        entry['logfiles'][l['name']] = '%s-%s.log.gz' % (prefix, l['slug'])
+                        entry['bytes'] += save(
+                            os.path.join(args.out, entry['logfiles'][l['name']]),
+                            log_contents(args.master, l['logid']).splitlines(True))
+                manifest['commands'].append(entry)
+                print('%s: %s (%d bytes)' % (builder_name, display, entry['bytes']))
+
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+####### drive
+
+def cpu_seconds(pid):
+    with open('/proc/%d/stat' % pid) as f:
+        # the command name may contain spaces; fields after it are fixed
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+
+def db_size(engine):
+    with engine.connect() as conn:
+        if engine.dialect.name == 'postgresql':
+            return conn.execute(
+                'SELECT pg_database_size(current_database())').scalar()
+    return os.path.getsize(engine.url.database)
+
+def replayed_bytes(workers_dir):
+    total = 0
+    for path in glob.glob(os.path.join(workers_dir, '*', 'replayed-bytes')):
+        with open(path) as f:
+            total += int(f.read().strip() or 0)
+    return total
+
+def snapshot(args, engine):
+    return {
+        'time': time.time(),
+        'cpu': cpu_seconds(args.master_pid),
+        'db': db_size(engine),
+        'log_bytes': replayed_bytes(args.workers_dir),
+    }
+
+def wait_for_workers(args):
+    deadline = time.time() + args.timeout
+    while True:
+        workers = api(args.master, 'workers')['workers']
+        connected = [w for w in workers
+                     if w['name'].startswith('loadtest-') and w['connected_to']]
+        if len(connected) >= args.workers:
+            return
+        if time.time() > deadline:
+            sys.exit('only %d of %d workers connected' % (len(connected), args.workers))
+        time.sleep(2)
+
+def drive(args):
+    engine = sa.create_engine(args.db_url)
+    wait_for_workers(args)
+    builders = [name for name in
+                api(args.master, 'forceschedulers/loadtest')['forceschedulers'][0]['builder_names']
+                if any(fnmatch.fnmatch(name, pattern) for pattern in args.builders)]
+    if not builders:
+        sys.exit('no builders match %s' % ' '.join(args.builders))
+
+    before = snapshot(args, engine)
+    brids = []
+    for n in range(args.builds):
+        result = api(args.master, 'forceschedulers/loadtest', {
+            'jsonrpc': '2.0', 'method': 'force', 'id': n,
+            'params': {'builderNames': [builders[n % len(builders)]]},
+        })['result']
+        brids.extend(result[1].values())
+        if args.interval:
+            time.sleep(args.interval)
+
+    deadline = time.time() + args.timeout
+    requests = []
+    while True:
+        requests = [api(args.master, 'buildrequests/%d' % brid)['buildrequests'][0]
+                    for brid in brids]
+        if all(r['complete'] for r in requests):
+            break
+        if time.time() > deadline:
+            sys.exit('%d builds did not finish in time' % sum(
+                1 for r in requests if not r['complete']))
+        time.sleep(5)
+    after = snapshot(args, engine)
+
+    latencies = []
+    for r in requests:
+        for build in api(args.master, 'buildrequests/%d/builds' % r['buildrequestid'])['builds']:
+            latencies.append(build['started_at'] - r['submitted_at'])
+
+    elapsed = after['time'] - before['time']
+    log_mb = (after['log_bytes'] - before['log_bytes']) / 1024.0 / 1024
+    cpu = after['cpu'] - before['cpu']
+    results = {
+        'config': os.environ.get('LOADTEST_CONFIG', 'master.cfg-example'),
+        'workers': args.workers,
+        'builds': len(requests),
+        'elapsed_seconds': elapsed,
+        'builds_per_hour': len(requests) * 3600.0 / elapsed,
+        'scheduler_latency_p50': percentile(latencies, 50),
+        'scheduler_latency_p95': percentile(latencies, 95),
+        'scheduler_latency_max': max(latencies) if latencies else None,
+        'log_mb': log_mb,
+        'master_cpu_seconds': cpu,
+        'master_cpu_seconds_per_log_mb': cpu / log_mb if log_mb else None,
+        'db_growth_bytes': after['db'] - before['db'],
+        'db_growth_bytes_per_build': (after['db'] - before['db']) / float(len(requests)),
+    }
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    for name in sorted(results):
+        print('%-32s %s' % (name, results[name]))
+
+    if args.baseline:
+        sys.exit(compare(args.baseline, results, args.tolerance))
+
+# metric -> whether a higher value is better
+COMPARED = {
+    'builds_per_hour': True,
+    'scheduler_latency_p95': False,
+    'master_cpu_seconds_per_log_mb': False,
+    'db_growth_bytes_per_build': False,
+}
+
+def compare(baseline_path, results, tolerance):
+    """Return the number of metrics that regressed against the baseline."""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    regressions = 0
+    for name, higher_is_better in sorted(COMPARED.items()):
+        old, new = baseline.get(name), results.get(name)
+        if not old or new is None:
+            continue
+        change = (new - old) / float(old)
+        worse = -change if higher_is_better else change
+        if worse > tolerance:
+            regressions += 1
+            print('REGRESSION %s: %s -> %s (%+.1f%%)' % (name, old, new, change * 100))
+    return regressions
+
+####### sink
+
+class SinkHandler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(b'{}')
+
+    def log_message(self, format, *args):
+        pass
+
+def sink(args):
+    http.server.HTTPServer(('localhost', args.port), SinkHandler).serve_forever()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='command')
+    sub.required = True
+
+    p = sub.add_parser('render')
+    p.add_argument('--vars', required=True, help='JSON file of template variables')
+    p.add_argument('--set', action='append', default=[], metavar='NAME=VALUE')
+    p.add_argument('files', nargs='+', help='files to render in place')
+    p.set_defaults(func=render)
+
+    p = sub.add_parser('record')
+    p.add_argument('--master', required=True, help='URL of the master to record from')
+    p.add_argument('--out', required=True, help='recordings directory')
+    p.add_argument('builds', nargs='+', metavar='BUILDER/NUMBER')
+    p.set_defaults(func=record)
+
+    p = sub.add_parser('drive')
+    p.add_argument('--master', default='http://localhost:8010/')
+    p.add_argument('--master-pid', type=int, required=True)
+    p.add_argument('--db-url', required=True)
+    p.add_argument('--workers-dir', required=True)
+    p.add_argument('--workers', type=int, default=24)
+    p.add_argument('--builds', type=int, default=100)
+    p.add_argument('--builders', nargs='+', default=['*'], metavar='PATTERN')
+    p.add_argument('--interval', type=float, default=0,
+                   help='seconds between forced builds')
+    p.add_argument('--timeout', type=float, default=6 * 3600)
+    p.add_argument('--output', default='loadtest-results.json')
+    p.add_argument('--baseline', help='results of an earlier run to compare with')
+    p.add_argument('--tolerance', type=float, default=0.1,
+                   help='relative change counted as a regression')
+    p.set_defaults(func=drive)
+
+    p = sub.add_parser('sink')
+    p.add_argument('--port', type=int, default=8099)
+    p.set_defaults(func=sink)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+"""
+Fake worker commands for the load test.
+
+Instead of running shell commands, ReplayShellCommand streams the output that
+`loadtest.py record` saved from a real build of the same command, at the
+recorded pace scaled by REPLAY_TIME_SCALE. Recordings are matched on the
+builder name and the command line as it appears in the step header; commands
+without a recording finish immediately and successfully.
+
+Recordings are gzipped logs in buildbot's stream format: each line prefixed
+with `o` (stdout), `e` (stderr) or `h` (header). Manifest entries give the
+recording of the stdio and of each logfile, the exit code, the elapsed time
+and the total number of bytes; short outputs can be given inline as `stdout`.
+"""
+
+import fnmatch
+import gzip
+import json
+import os
+
+from twisted.internet import defer, task
+from twisted.python import log
+
+from buildbot_worker.commands import base, registry
+from buildbot_worker.commands.transfer import (
+    WorkerDirectoryUploadCommand,
+    WorkerFileUploadCommand,
+)
+from buildbot_worker.runprocess import shell_quote
+
+CHUNK_SIZE = 64 * 1024
+
+def load_manifests(paths):
+    """Read the replay entries of every manifest, in order."""
+    entries = []
+    for path in paths:
+        with open(path) as f:
+            manifest = json.load(f)
+        for entry in manifest['commands']:
+            entry = dict(entry)
+            if 'stdio' in entry:
+                entry['stdio'] = os.path.join(os.path.dirname(path), entry['stdio'])
+            entry['logfiles'] = {
+                name: os.path.join(os.path.dirname(path), filename)
+                for name, filename in entry.get('logfiles', {}).items()}
+            entries.append(entry)
+    return entries
+
+def find_entry(entries, builder, display):
+    for entry in entries:
+        if not fnmatch.fnmatchcase(builder, entry.get('builder', '*')):
+            continue
+        if fnmatch.fnmatchcase(display, entry['match']):
+            return entry
+    return {}
+
+def read_chunks(path):
+    """Yield (stream, data) chunks of a recording, leaving out headers."""
+    stream, data = None, []
+    size = 0
+    with gzip.open(path, 'rt', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            if not line or line[0] == 'h':
+                continue
+            if line[0] != stream or size >= CHUNK_SIZE:
+                if data:
+                    yield stream, ''.join(data)
+                stream, data, size = line[0], [], 0
+            data.append(line[1:])
+            size += len(line)
+    if data:
+        yield stream, ''.join(data)
+
+class ReplayStats(object):
+    """Bytes replayed by this worker, read by `loadtest.py drive`."""
+    def __init__(self, basedir):
+        self.path = os.path.join(basedir, 'replayed-bytes')
+        self.total = 0
+
+    def add(self, n):
+        self.total += n
+        with open(self.path, 'w') as f:
+            f.write('%d\n' % self.total)
+
+class ReplayShellCommand(base.Command):
+    requiredArgs = ['workdir', 'command']
+
+    entries = []
+    stats = None
+    time_scale = 1.0
+
+    def start(self):
+        self.interrupted = False
+        command = self.args['command']
+        if isinstance(command, (list, tuple)):
+            # secrets are sent as ('obfuscated', real, fake)
+            command = [w[2] if isinstance(w, tuple) else w for w in command]
+            display = shell_quote(command, self.builder.unicode_encoding)
+        else:
+            display = command
+        if isinstance(display, bytes):
+            display = display.decode(self.builder.unicode_encoding)
+        entry = find_entry(self.entries, self.builder.name, display)
+        # as if the replayed checkout had created it
+        os.makedirs(os.path.join(self.builder.basedir, self.args['workdir']),
+                    exist_ok=True)
+        self.sendStatus({'header': '%s (replayed)\n' % display})
+        d = self.replay(entry)
+        d.addCallback(lambda _: self.sendStatus(
+            {'rc': -1 if self.interrupted else entry.get('rc', 0)}))
+        return d
+
+    @defer.inlineCallbacks
+    def replay(self, entry):
+        sources = []
+        if 'stdio' in entry:
+            sources.append((None, entry['stdio']))
+        for name in self.args.get('logfiles', {}):
+            if name in entry.get('logfiles', {}):
+                sources.append((name, entry['logfiles'][name]))
+
+        duration = entry.get('elapsed', 0) * self.time_scale
+        total = entry.get('bytes') or 1
+        started = self._reactor.seconds()
+        sent = 0
+        if entry.get('stdout'):
+            self.sendStatus({'stdout': entry['stdout']})
+        for logname, path in sources:
+            for stream, data in read_chunks(path):
+                if self.interrupted:
+                    return
+                if logname is not None:
+                    self.sendStatus({'log': (logname, data)})
+                elif stream == 'e':
+                    self.sendStatus({'stderr': data})
+                else:
+                    self.sendStatus({'stdout': data})
+                self.stats.add(len(data))
+                # spread the output evenly over the recorded duration
+                sent += len(data)
+                yield self.sleepUntil(
+                    started + duration * min(1, float(sent) / total))
+        yield self.sleepUntil(started + duration)
+
+    def sleepUntil(self, when):
+        delay = max(0, when - self._reactor.seconds())
+        return task.deferLater(self._reactor, delay, lambda: None)
+
+    def interrupt(self):
+        self.interrupted = True
+
+    def writeStdin(self, data):
+        pass
+
+    def closeStdin(self):
+        pass
+
+class ReplayFileUploadCommand(WorkerFileUploadCommand):
+    """Uploads an empty file when the replayed build did not produce one."""
+    def start(self):
+        path = os.path.normpath(os.path.join(
+            self.builder.basedir, self.workdir, os.path.expanduser(self.filename)))
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, 'w').close()
+        return WorkerFileUploadCommand.start(self)
+
+class ReplayDirectoryUploadCommand(WorkerDirectoryUploadCommand):
+    """Uploads an empty directory when the replayed build did not produce one."""
+    def start(self):
+        path = os.path.normpath(os.path.join(
+            self.builder.basedir, self.workdir, os.path.expanduser(self.dirname)))
+        os.makedirs(path, exist_ok=True)
+        return WorkerDirectoryUploadCommand.start(self)
+
+def install(basedir, manifests, time_scale):
+    """Replace the worker's shell and upload commands with the replay ones."""
+    ReplayShellCommand.entries = load_manifests(manifests)
+    ReplayShellCommand.stats = ReplayStats(basedir)
+    ReplayShellCommand.time_scale = time_scale
+    registry.commandRegistry['shell'] = ReplayShellCommand
+    registry.commandRegistry['uploadFile'] = ReplayFileUploadCommand
+    registry.commandRegistry['uploadDirectory'] = ReplayDirectoryUploadCommand
+    log.msg('replaying %d recorded commands' % len(ReplayShellCommand.entries))